@@ -2,7 +2,7 @@
 
 __all__ = ["index", "modules", "custom_doc_links", "git_url"]
 
-index = {"logger": "95_cli.ipynb",
+index = {"logger": "96_benchmarks.ipynb",
          "CocoElement": "01_coco.ipynb",
          "CocoInfo": "01_coco.ipynb",
          "CocoLicense": "01_coco.ipynb",
@@ -12,9 +12,13 @@ index = {"logger": "95_cli.ipynb",
          "CocoCategory": "01_coco.ipynb",
          "CocoObjectDetectionCategory": "01_coco.ipynb",
          "CocoDataset": "01_coco.ipynb",
+         "CocoIndex": "01_coco.ipynb",
          "CocoObjectDetectionDataset": "01_coco.ipynb",
          "get_dataset_class": "01_coco.ipynb",
          "MAP_COCO_TYPE_TO_DATASET_CLASS": "01_coco.ipynb",
+         "LoadFilter": "01_coco.ipynb",
+         "construct_dataset": "01_coco.ipynb",
+         "merge_all_datasets": "01_coco.ipynb",
          "merge_datasets": "01_coco.ipynb",
          "shuffle": "01_coco.ipynb",
          "cut_annotations_per_category": "01_coco.ipynb",
@@ -23,26 +27,81 @@ index = {"logger": "95_cli.ipynb",
          "dump_json_file": "02_json_file.ipynb",
          "load_json_tree": "03_json_tree.ipynb",
          "dump_json_tree": "03_json_tree.ipynb",
+         "FINGERPRINTS_FILE": "03_json_tree.ipynb",
          "load_crop_tree": "04_crop_tree.ipynb",
+         "CROPS_INDEX_FILE": "04_crop_tree.ipynb",
          "dump_crop_tree": "04_crop_tree.ipynb",
+         "CROPS_JOURNAL_FILE": "04_crop_tree.ipynb",
+         "ColumnarObjectDetectionDataset": "05_columnar.ipynb",
+         "validate_dataset": "05_columnar.ipynb",
+         "CompactElement": "06_compact.ipynb",
+         "CompactImage": "06_compact.ipynb",
+         "CompactObjectDetectionAnnotation": "06_compact.ipynb",
+         "CompactObjectDetectionCategory": "06_compact.ipynb",
+         "CompactObjectDetectionDataset": "06_compact.ipynb",
+         "get_bytes_per_element": "06_compact.ipynb",
+         "get_rss": "90_utils.ipynb",
+         "MemoryStage": "90_utils.ipynb",
+         "MemoryMonitor": "90_utils.ipynb",
+         "start_memory_monitoring": "90_utils.ipynb",
+         "stop_memory_monitoring": "90_utils.ipynb",
+         "get_memory_monitor": "90_utils.ipynb",
+         "detach_memory_monitoring": "90_utils.ipynb",
+         "memory_monitoring": "90_utils.ipynb",
          "TimerMutable": "90_utils.ipynb",
+         "Tracer": "90_utils.ipynb",
+         "start_tracing": "90_utils.ipynb",
+         "stop_tracing": "90_utils.ipynb",
+         "get_tracer": "90_utils.ipynb",
+         "tracing": "90_utils.ipynb",
+         "add_span": "90_utils.ipynb",
          "measure_time": "90_utils.ipynb",
          "log_elapsed_time": "90_utils.ipynb",
+         "traced": "90_utils.ipynb",
          "sort_dict": "90_utils.ipynb",
+         "set_json_backend": "90_utils.ipynb",
+         "get_json_backend": "90_utils.ipynb",
+         "json_loads": "90_utils.ipynb",
+         "json_dumps": "90_utils.ipynb",
          "sanitize_filename": "90_utils.ipynb",
          "read_image": "90_utils.ipynb",
          "download_image": "90_utils.ipynb",
          "cut_bbox": "90_utils.ipynb",
          "write_image": "90_utils.ipynb",
-         "get_parser": "95_cli.ipynb",
-         "main": "95_cli.ipynb"}
+         "encode_image": "90_utils.ipynb",
+         "delete_extra_files": "90_utils.ipynb",
+         "open_atomic": "90_utils.ipynb",
+         "get_compression": "90_utils.ipynb",
+         "get_compression_suffix": "90_utils.ipynb",
+         "strip_compression_suffix": "90_utils.ipynb",
+         "open_compressed": "90_utils.ipynb",
+         "compress_bytes": "90_utils.ipynb",
+         "CompressedTextWriter": "90_utils.ipynb",
+         "open_output": "90_utils.ipynb",
+         "ImagePrefetcher": "91_download.ipynb",
+         "Stage": "92_pipeline.ipynb",
+         "StageStats": "92_pipeline.ipynb",
+         "Pipeline": "92_pipeline.ipynb",
+         "get_parser": "96_benchmarks.ipynb",
+         "main": "96_benchmarks.ipynb",
+         "generate_dataset": "96_benchmarks.ipynb",
+         "write_images": "96_benchmarks.ipynb",
+         "Benchmark": "96_benchmarks.ipynb",
+         "get_benchmarks": "96_benchmarks.ipynb",
+         "run_benchmarks": "96_benchmarks.ipynb",
+         "compare_results": "96_benchmarks.ipynb"}
 
 modules = ["coco.py",
            "json_file.py",
            "json_tree.py",
            "crop_tree.py",
+           "columnar.py",
+           "compact.py",
            "utils.py",
-           "cli.py"]
+           "download.py",
+           "pipeline.py",
+           "cli.py",
+           "benchmarks.py"]
 
 doc_url = "https://neuro-inc.github.io/cocorepr/cocorepr/"
 
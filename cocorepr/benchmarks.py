@@ -0,0 +1,380 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/96_benchmarks.ipynb (unless otherwise specified).
+
+__all__ = ['logger', 'generate_dataset', 'write_images', 'Benchmark', 'get_benchmarks', 'run_benchmarks',
+           'compare_results', 'get_parser', 'main']
+
+# Cell
+
+import argparse
+import datetime
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import *
+
+import cv2
+import numpy as np
+
+try:
+    from . import __version__
+except ImportError:  # the notebook itself is not a part of the package
+    from cocorepr import __version__
+from .coco import *
+from .json_file import load_json_file, dump_json_file
+from .json_tree import load_json_tree, dump_json_tree
+from .crop_tree import load_crop_tree, dump_crop_tree
+from .compact import *  # registers kind 'compact_object_detection'
+
+# Cell
+logger = logging.getLogger()
+
+# Cell
+
+def generate_dataset(
+    num_annotations: int,
+    *,
+    anns_per_image: int = 5,
+    num_categories: Optional[int] = None,
+    invalid_ratio: float = 0.0,
+    seed: int = 0,
+) -> CocoObjectDetectionDataset:
+    """ Returns a synthetic object detection dataset of `num_annotations` annotations
+        on images of at most 64x64 pixels. By default, there is one category per
+        1000 annotations (from 10 to 1000). A fraction `invalid_ratio` of the
+        annotations has broken bboxes (see `remove_invalid_elements`).
+    """
+    rng = random.Random(seed)
+    num_images = max(1, math.ceil(num_annotations / anns_per_image))
+    if num_categories is None:
+        num_categories = min(1000, max(10, num_annotations // 1000))
+
+    categories = [
+        CocoObjectDetectionCategory.from_dict_trusted({
+            'id': str(i), 'name': f'category {i}', 'supercategory': f'supercategory {i % 10}',
+        })
+        for i in range(1, num_categories + 1)
+    ]
+    licenses = [
+        CocoLicense.from_dict_trusted({'id': str(i), 'name': f'license {i}', 'url': f'http://licenses.invalid/{i}'})
+        for i in range(1, 5)
+    ]
+    images = []
+    for i in range(1, num_images + 1):
+        file_name = f'{i:08d}.png'
+        images.append(CocoImage.from_dict_trusted({
+            'id': str(i),
+            'coco_url': f'http://images.invalid/{file_name}',
+            'width': rng.randint(32, 64),
+            'height': rng.randint(32, 64),
+            'license': rng.randint(1, 4),
+            'file_name': file_name,
+        }))
+    annotations = []
+    for i in range(num_annotations):
+        img = images[i // anns_per_image]
+        x, y = rng.randrange(img.width - 8), rng.randrange(img.height - 8)
+        w, h = rng.randint(4, img.width - x), rng.randint(4, img.height - y)
+        if rng.random() < invalid_ratio:
+            w = -w
+        annotations.append(CocoObjectDetectionAnnotation.from_dict_trusted({
+            'id': str(i + 1),
+            'image_id': img.id,
+            'category_id': str(rng.randint(1, num_categories)),
+            'bbox': [x, y, w, h],
+            'area': w * h,
+            'iscrowd': 0,
+        }))
+    info = CocoInfo.from_dict_trusted({'year': 2021, 'version': '1.0', 'description': f'synthetic, seed {seed}'})
+    return CocoObjectDetectionDataset.from_dict_trusted({
+        'annotations': annotations,
+        'images': images,
+        'categories': categories,
+        'licenses': licenses,
+        'info': info,
+    })
+
+
+def write_images(coco: CocoDataset, images_dir: Union[str, Path]) -> None:
+    """ Writes a tiny image for each image of the dataset (to `images_dir/file_name`).
+    """
+    images_dir = Path(images_dir)
+    images_dir.mkdir(parents=True, exist_ok=True)
+    for img in coco.images:
+        rng = np.random.default_rng(int(img.id))
+        image = rng.integers(0, 256, size=(img.height, img.width, 3), dtype=np.uint8)
+        cv2.imwrite(str(images_dir / img.get_file_name()), image)
+
+# Cell
+
+@dataclass
+class Benchmark:
+    name: str
+    run: Callable[[Any], Any]
+    setup: Callable[[], Any]  # called before each run, the result is passed to `run`
+
+
+class _Inputs:
+    """ Inputs of the benchmarks, each one is created on first use.
+    """
+    def __init__(self, work_dir: Path, size: int, crop_size: int, seed: int):
+        self.work_dir = work_dir
+        self.size = size
+        self.crop_size = crop_size
+        self.seed = seed
+        self._cache = {}
+
+    def get(self, name: str) -> Any:
+        """ Returns the input `name` created by `self._create_<name>()`.
+        """
+        if name not in self._cache:
+            self._cache[name] = getattr(self, f'_create_{name}')()
+        return self._cache[name]
+
+    def get_output(self, name: str) -> Path:
+        path = self.work_dir / 'output' / name
+        if path.is_dir():
+            shutil.rmtree(str(path))
+        elif path.exists():
+            path.unlink()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def _create_dataset(self) -> CocoDataset:
+        return generate_dataset(self.size, seed=self.seed)
+
+    def _create_invalid_dataset(self) -> CocoDataset:
+        return generate_dataset(self.size, invalid_ratio=0.01, seed=self.seed)
+
+    def _create_halves(self) -> Tuple[CocoDataset, CocoDataset]:
+        """ Two datasets sharing a half of their elements.
+        """
+        coco = self.get('dataset')
+        n = len(coco.annotations)
+        return (
+            replace(coco, annotations=coco.annotations[:3 * n // 4]),
+            replace(coco, annotations=coco.annotations[n // 4:]),
+        )
+
+    def _create_json_file(self) -> Path:
+        path = self.work_dir / 'input' / 'dataset.json'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        dump_json_file(self.get('dataset'), path, overwrite=True)
+        return path
+
+    def _create_json_file_gzip(self) -> Path:
+        path = self.work_dir / 'input' / 'dataset.json.gz'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        dump_json_file(self.get('dataset'), path, overwrite=True)
+        return path
+
+    def _create_json_tree(self) -> Path:
+        path = self.work_dir / 'input' / 'json_tree'
+        dump_json_tree(self.get('dataset'), path, overwrite=True)
+        return path
+
+    def _create_crop_dataset(self) -> CocoDataset:
+        return generate_dataset(self.crop_size, seed=self.seed)
+
+    def _create_images_dir(self) -> Path:
+        path = self.work_dir / 'input' / 'images'
+        write_images(self.get('crop_dataset'), path)
+        return path
+
+    def _create_crop_tree(self) -> Path:
+        path = self.work_dir / 'input' / 'crop_tree'
+        shutil.copytree(str(self.get('images_dir')), str(path / 'images'))
+        dump_crop_tree(self.get('crop_dataset'), path, overwrite=True, download_workers=0)
+        return path
+
+    def get_crop_tree_output(self) -> Path:
+        """ An output dir of `dump_crop_tree` with the images in place (hard links when possible).
+        """
+        path = self.get_output('crop_tree')
+        shutil.copytree(str(self.get('images_dir')), str(path / 'images'), copy_function=_link_or_copy)
+        return path
+
+
+def _link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def get_benchmarks(work_dir: Union[str, Path], size: int, *, crop_size: Optional[int] = None, seed: int = 0) -> List[Benchmark]:
+    """ Returns the benchmarks of the load, dump and transform functions on synthetic
+        datasets of `size` annotations (`crop_size` for the crop_tree ones, by default
+        up to 10000). The inputs are created under `work_dir`.
+    """
+    if crop_size is None:
+        crop_size = min(size, 10000)
+    inputs = _Inputs(Path(work_dir), size, crop_size, seed)
+
+    def _cut(coco):
+        return cut_annotations_per_category(coco, max(1, len(coco.annotations) // len(coco.categories) // 2))
+
+    # the inputs are taken in `setup`, so that they are created out of the measured runs
+    return [
+        Benchmark('load_json_file', load_json_file, lambda: inputs.get('json_file')),
+        Benchmark('load_json_file_trusted', lambda path: load_json_file(path, trusted=True), lambda: inputs.get('json_file')),
+        Benchmark('load_json_file_stream', lambda path: load_json_file(path, stream=True), lambda: inputs.get('json_file')),
+        Benchmark('load_json_file_compact', lambda path: load_json_file(path, trusted=True, kind='compact_object_detection'),
+                  lambda: inputs.get('json_file')),
+        Benchmark('load_json_file_gzip', load_json_file, lambda: inputs.get('json_file_gzip')),
+        Benchmark('dump_json_file', lambda args: dump_json_file(*args),
+                  lambda: (inputs.get('dataset'), inputs.get_output('dataset.json'))),
+        Benchmark('dump_json_file_gzip', lambda args: dump_json_file(*args),
+                  lambda: (inputs.get('dataset'), inputs.get_output('dataset.json.gz'))),
+        Benchmark('load_json_tree', load_json_tree, lambda: inputs.get('json_tree')),
+        Benchmark('load_json_tree_trusted', lambda path: load_json_tree(path, trusted=True), lambda: inputs.get('json_tree')),
+        Benchmark('dump_json_tree', lambda args: dump_json_tree(*args),
+                  lambda: (inputs.get('dataset'), inputs.get_output('json_tree'))),
+        Benchmark('merge_datasets', lambda args: merge_datasets(*args), lambda: inputs.get('halves')),
+        Benchmark('cut_annotations_per_category', _cut, lambda: inputs.get('dataset')),
+        Benchmark('remove_invalid_elements', remove_invalid_elements, lambda: inputs.get('invalid_dataset')),
+        Benchmark('load_crop_tree', lambda args: load_crop_tree(*args),
+                  lambda: (inputs.get('crop_tree'), inputs.get('crop_dataset'))),
+        Benchmark('dump_crop_tree', lambda args: dump_crop_tree(*args, overwrite=True, download_workers=0),
+                  lambda: (inputs.get('crop_dataset'), inputs.get_crop_tree_output())),
+    ]
+
+# Cell
+
+def run_benchmarks(
+    benchmarks: List[Benchmark],
+    *,
+    repeat: int = 3,
+    memory: bool = True,
+) -> Dict[str, Dict[str, Any]]:
+    """ Runs the benchmarks and returns `{name: {"time": best, "times": [...], "peak_memory": bytes}}`
+        (times in seconds, `peak_memory` is `None` unless `memory` is set).
+    """
+    results = {}
+    for bench in benchmarks:
+        times = []
+        for _ in range(repeat):
+            arg = bench.setup()
+            start = time.perf_counter()
+            bench.run(arg)
+            times.append(time.perf_counter() - start)
+        peak_memory = None
+        if memory:
+            arg = bench.setup()
+            tracemalloc.start()
+            try:
+                bench.run(arg)
+                _, peak_memory = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+        results[bench.name] = {'time': min(times), 'times': times, 'peak_memory': peak_memory}
+        logger.info(f'Benchmark {bench.name}: {_format_result(results[bench.name])}')
+    return results
+
+
+def _format_result(result: Dict[str, Any]) -> str:
+    s = f"{result['time']:.3f}s"
+    if result.get('peak_memory') is not None:
+        s += f", peak memory {result['peak_memory'] / 2 ** 20:.1f} MiB"
+    return s
+
+
+def compare_results(
+    baseline: Dict[str, Dict[str, Any]],
+    results: Dict[str, Dict[str, Any]],
+    *,
+    tolerance: float = 0.2,
+) -> List[str]:
+    """ Returns descriptions of the regressions: the benchmarks whose time or peak memory
+        exceeds the one of `baseline` by more than `tolerance` (relative).
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for key in ['time', 'peak_memory']:
+            if result.get(key) is None or not base.get(key):
+                continue
+            ratio = result[key] / base[key]
+            if ratio > 1 + tolerance:
+                regressions.append(f'{name}: {key} {base[key]:.6g} -> {result[key]:.6g} ({ratio:.2f}x)')
+    return regressions
+
+# Cell
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of cocorepr on synthetic datasets"
+    )
+    parser.add_argument("--size", type=int, default=10000,
+                        help="Number of annotations of the synthetic dataset (e.g. from 1000 to 10000000).")
+    parser.add_argument("--crop_size", type=int, default=None,
+                        help="Number of annotations of the dataset for crop_tree benchmarks (by default, up to 10000).")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic datasets.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each benchmark (the best time is taken).")
+    parser.add_argument("--only", nargs="*", default=[], help="Names of the benchmarks to run (by default, all).")
+    parser.add_argument("--no_memory", action='store_true', help="If set, peak memory is not measured.")
+    parser.add_argument("--work_dir", type=Path,
+                        help="Directory for the inputs and outputs (by default, a temporary one which is removed in the end).")
+    parser.add_argument("--out", type=Path, help="Path to the json file to save the results to.")
+    parser.add_argument("--compare", type=Path, help="Path to the json file with the results of a previous run.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Relative increase of time or memory reported as regression by `--compare`.")
+    parser.add_argument("--debug", action='store_true')
+    return parser
+
+
+def main(args=None):
+    args = args or get_parser().parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format='%(levelname)s: %(message)s')
+
+    work_dir = args.work_dir or Path(tempfile.mkdtemp(prefix='cocorepr-benchmarks-'))
+    try:
+        benchmarks = get_benchmarks(work_dir, args.size, crop_size=args.crop_size, seed=args.seed)
+        if args.only:
+            unknown = set(args.only) - {b.name for b in benchmarks}
+            if unknown:
+                raise ValueError(f'Unknown benchmarks: {sorted(unknown)}')
+            benchmarks = [b for b in benchmarks if b.name in args.only]
+        results = run_benchmarks(benchmarks, repeat=args.repeat, memory=not args.no_memory)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(str(work_dir), ignore_errors=True)
+
+    report = {
+        'meta': {
+            'size': args.size,
+            'crop_size': args.crop_size,
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'cocorepr': __version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        },
+        'results': results,
+    }
+    if args.out:
+        args.out.write_text(json.dumps(report, indent=4))
+        logger.info(f'Results saved to {args.out}')
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        if baseline['meta']['size'] != args.size:
+            logger.warning(f"Comparing with results of a different size: {baseline['meta']['size']}")
+        regressions = compare_results(baseline['results'], results, tolerance=args.tolerance)
+        for regression in regressions:
+            logger.warning(f'Regression: {regression}')
+        if regressions:
+            sys.exit(1)
+        logger.info(f'No regressions compared to {args.compare}')
\ No newline at end of file
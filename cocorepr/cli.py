@@ -5,15 +5,19 @@ __all__ = ['logger', 'get_parser', 'main']
 # Cell
 
 import argparse
+import itertools
 import logging
+from contextlib import ExitStack
 from pathlib import Path
 import random
 
-from .utils import log_elapsed_time
-from .coco import merge_datasets, cut_annotations_per_category, remove_invalid_elements
+from .utils import log_elapsed_time, tracing, memory_monitoring
+from .coco import merge_all_datasets, cut_annotations_per_category, LoadFilter
 from .json_file import *
 from .json_tree import *
 from .crop_tree import *
+from .columnar import validate_dataset
+from .compact import *  # registers kind 'compact_object_detection'
 
 # Cell
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
@@ -28,7 +32,8 @@ def get_parser():
     parser.add_argument("--in_json_file", type=Path, nargs="*", default=[],
                         help=(
                             "Path to one or multiple json files storing COCO dataset "
-                            "in `json_file` representation (all json-based datasets will be merged)."
+                            "in `json_file` representation (all json-based datasets will be merged). "
+                            "Files compressed by gzip, xz or bz2 (`.json.gz`, `.json.xz`, `.json.bz2`) are supported."
                         ))
 
     parser.add_argument("--in_json_tree", type=Path, nargs="*", default=[],
@@ -44,6 +49,58 @@ def get_parser():
                             "overwrite the json-based datasets)."
                        ))
 
+    parser.add_argument("--stream_json_file", action='store_true',
+                        help=(
+                            "If set, datasets from `--in_json_file` will be parsed incrementally element by element "
+                            "instead of reading the whole file at once (lower peak memory on large files)."
+                        ))
+
+    parser.add_argument("--lazy_input", action='store_true',
+                        help=(
+                            "If set, each collection of `--in_json_file` and `--in_json_tree` datasets is loaded "
+                            "on the first access to it. A json_file is still parsed as a whole unless "
+                            "`--stream_json_file` is set too."
+                        ))
+
+    parser.add_argument("--trusted_input", action='store_true',
+                        help=(
+                            "If set, elements of `--in_json_file` and `--in_json_tree` datasets will be constructed "
+                            "without validation (much faster). Use only for valid datasets, for example, dumped by cocorepr."
+                        ))
+
+    parser.add_argument("--load_workers", type=int, default=1,
+                        help="Number of threads reading element files of `--in_json_tree` datasets concurrently.")
+
+    parser.add_argument("--compact_elements", action='store_true',
+                        help=(
+                            "If set, elements of `--in_json_file` and `--in_json_tree` datasets are kept in memory "
+                            "as compact objects (slotted, with interned repeated strings): ~2.5x less memory per annotation."
+                        ))
+
+    parser.add_argument("--load_collections", nargs="+",
+                        help=(
+                            "If set, only these collections (e.g. `annotations images categories`) of `--in_json_file` "
+                            "and `--in_json_tree` datasets are loaded, the others are left empty (also in the output)."
+                        ))
+
+    parser.add_argument("--load_category_ids", nargs="+",
+                        help=(
+                            "If set, only the annotations and categories with these category IDs are loaded "
+                            "from `--in_json_file` and `--in_json_tree` datasets."
+                        ))
+
+    parser.add_argument("--load_image_ids", nargs="+",
+                        help=(
+                            "If set, only the annotations and images with these image IDs are loaded "
+                            "from `--in_json_file` and `--in_json_tree` datasets."
+                        ))
+
+    parser.add_argument("--load_min_bbox_area", type=float,
+                        help=(
+                            "If set, only the annotations with bbox area (width * height) not less than this value "
+                            "are loaded from `--in_json_file` and `--in_json_tree` datasets."
+                        ))
+
     parser.add_argument("--out_path", type=Path,
                         help="Path to the output dataset (file or directory: depends on `--out_format`)")
 
@@ -62,8 +119,40 @@ def get_parser():
 
     parser.add_argument("--dump_crop_tree_num_processes", type=int, default=1)
 
+    parser.add_argument("--download_workers", type=int, default=8,
+                        help=(
+                            "Number of threads downloading missing images ahead of the processing "
+                            "for `--out_format crop_tree` (0 to download them in the processes)."
+                        ))
+
+    parser.add_argument("--write_workers", type=int, default=2,
+                        help="Number of threads writing crops to files for `--out_format crop_tree`.")
+
+    parser.add_argument("--json_tree_shard_size", type=int, default=None,
+                        help=(
+                            "If set, `--out_format json_tree` packs elements into ndjson shards of about "
+                            "this number of elements instead of writing one json file per element."
+                        ))
+
+    parser.add_argument("--json_tree_compression", choices=['gzip', 'xz', 'bz2'], default=None,
+                        help=(
+                            "If set, the ndjson shards of `--out_format json_tree` are compressed "
+                            "(requires `--json_tree_shard_size`). To compress the output of `--out_format json_file`, "
+                            "give `--out_path` the suffix `.gz`, `.xz` or `.bz2`."
+                        ))
+
     parser.add_argument("--overwrite", action='store_true',
                         help="If set, will delete the output file/directory before dumping the result dataset.")
+    parser.add_argument("--incremental", action='store_true',
+                        help=(
+                            "If set, `--out_format json_tree` updates an existing output directory in place: "
+                            "only new and changed element files are written and removed ones are deleted."
+                        ))
+    parser.add_argument("--resume", action='store_true',
+                        help=(
+                            "If set, `--out_format crop_tree` continues an interrupted dump into an existing output "
+                            "directory: the crops recorded in its journal are skipped without checking the files."
+                        ))
     parser.add_argument("--indent", default=4,
                         type=lambda x: int(x) if str(x).lower() not in ('none', 'null', '~') else None,
                         help="Indentation in the output json files.")
@@ -74,16 +163,42 @@ def get_parser():
              "Beware, crop_tree datasets are owerwritting and removing data from other datasets: "
              "consider first merging crop_tree with it's json_tree/file into json_tree/file and merge the resulting dataset with others."
     )
+    parser.add_argument("--trace_out", type=Path,
+                        help=(
+                            "If set, timings of all the load, merge, filter and dump steps (including the ones "
+                            "in worker processes) are saved to this file in Chrome trace format "
+                            "(open in chrome://tracing or https://ui.perfetto.dev)."
+                        ))
+    parser.add_argument("--memory_out", type=Path,
+                        help=(
+                            "If set, RSS of the process before, after and at peak of each load, merge, filter "
+                            "and dump step is logged and saved to this json file."
+                        ))
+    parser.add_argument("--memory_top_allocations", type=int, default=0,
+                        help=(
+                            "With `--memory_out`, also record this number of the source lines which allocated "
+                            "most memory during each step (uses tracemalloc, which slows down the run)."
+                        ))
     parser.add_argument("--debug", action='store_true')
 
     return parser
 
 # Cell
 
-@log_elapsed_time(lambda t: logger.info(f'Total elapsed: {t.elapsed}'))
 def main(args=None):
     args = args or get_parser().parse_args()
-
+    if args.memory_top_allocations and args.memory_out is None:
+        raise ValueError(f'Option --memory_top_allocations requires --memory_out')
+    with ExitStack() as stack:
+        if args.trace_out is not None:
+            stack.enter_context(tracing(args.trace_out))
+        if args.memory_out is not None:
+            stack.enter_context(memory_monitoring(args.memory_out, top_allocations=args.memory_top_allocations))
+        return _main(args)
+
+
+@log_elapsed_time(lambda t: logger.info(f'Total elapsed: {t.elapsed}'), name='cocorepr')
+def _main(args):
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
 
@@ -92,6 +207,15 @@ def main(args=None):
     in_json_tree_list = args.in_json_tree
     in_json_file_list = args.in_json_file
     in_crop_tree_list = args.in_crop_tree
+    stream_json_file = args.stream_json_file
+    lazy_input = args.lazy_input
+    trusted_input = args.trusted_input
+    load_workers = args.load_workers
+    compact_elements = args.compact_elements
+    load_collections = args.load_collections
+    load_category_ids = args.load_category_ids
+    load_image_ids = args.load_image_ids
+    load_min_bbox_area = args.load_min_bbox_area
 
     seed = args.seed
     max_crops_per_class = args.max_crops_per_class
@@ -100,23 +224,47 @@ def main(args=None):
     out_path = args.out_path
     out_format = args.out_format
     dump_crop_tree_num_processes = args.dump_crop_tree_num_processes
+    download_workers = args.download_workers
+    write_workers = args.write_workers
+    json_tree_shard_size = args.json_tree_shard_size
+    json_tree_compression = args.json_tree_compression
     overwrite = args.overwrite
+    incremental = args.incremental
+    resume = args.resume
     indent = args.indent
     update: bool = args.update
 
     if out_path and not out_format or not out_path and out_format:
         raise ValueError(f'Option --out_format requires --out_path and vice versa')
+    if incremental and out_format != 'json_tree':
+        raise ValueError(f'Option --incremental requires --out_format json_tree')
+    if resume and out_format != 'crop_tree':
+        raise ValueError(f'Option --resume requires --out_format crop_tree')
 
     random.seed(args.seed)
 
-    coco = None
-    coco_count = 0
-    for in_json_tree in in_json_tree_list:
-        coco = merge_datasets(coco, load_json_tree(in_json_tree), update)
-        coco_count += 1
-    for in_json_file in in_json_file_list:
-        coco = merge_datasets(coco, load_json_file(in_json_file), update)
-        coco_count += 1
+    load_filter = None
+    if load_category_ids is not None or load_image_ids is not None or load_min_bbox_area is not None:
+        load_filter = LoadFilter(
+            category_ids=load_category_ids, image_ids=load_image_ids, min_bbox_area=load_min_bbox_area,
+        )
+        logger.info(f'Loading only the elements accepted by {load_filter}')
+    load_kwargs = dict(trusted=trusted_input, collections=load_collections, load_filter=load_filter, lazy=lazy_input)
+    if compact_elements:
+        load_kwargs['kind'] = 'compact_object_detection'
+
+    # datasets are loaded lazily one by one while being merged
+    coco = merge_all_datasets(itertools.chain(
+        (
+            load_json_tree(in_json_tree, num_workers=load_workers, **load_kwargs)
+            for in_json_tree in in_json_tree_list
+        ),
+        (
+            load_json_file(in_json_file, stream=stream_json_file, **load_kwargs)
+            for in_json_file in in_json_file_list
+        ),
+    ), update)
+    coco_count = len(in_json_tree_list) + len(in_json_file_list)
 
     if coco is None:
         raise ValueError(f'Not found base dataset, please specify either of: '
@@ -124,11 +272,10 @@ def main(args=None):
     if coco_count > 1:
         logger.info(f'Total loaded json dataset: {coco.to_full_str()}')
 
-    coco_crop = None
-    coco_crop_count = 0
-    for in_crop_tree in in_crop_tree_list:
-        coco_crop = merge_datasets(coco_crop, load_crop_tree(in_crop_tree, coco), update)
-        coco_crop_count += 1
+    coco_crop = merge_all_datasets(
+        (load_crop_tree(in_crop_tree, coco) for in_crop_tree in in_crop_tree_list), update
+    )
+    coco_crop_count = len(in_crop_tree_list)
     if coco_crop is not None:
         if coco_crop_count > 1:
             logger.info(f'Total loaded crop-tree dataset: {coco_crop.to_full_str()}')
@@ -136,7 +283,9 @@ def main(args=None):
         coco = coco_crop
 
     if drop_invalid_elements:
-        coco = remove_invalid_elements(coco)
+        coco, report = validate_dataset(coco)
+        violations = {rule: count for rule, count in report.items() if count}
+        logger.info(f'Invalid elements removed by rule: {violations}')
         logger.info(f'After removing invalid elements: {coco.to_full_str()}')
 
     if max_crops_per_class:
@@ -153,9 +302,15 @@ def main(args=None):
             dump_fun = dump_json_file
         elif out_format == 'json_tree':
             dump_fun = dump_json_tree
+            dump_kwargs['shard_size'] = json_tree_shard_size
+            dump_kwargs['compression'] = json_tree_compression
+            dump_kwargs['incremental'] = incremental
         elif out_format == 'crop_tree':
             dump_fun = dump_crop_tree
             dump_kwargs['num_processes'] = dump_crop_tree_num_processes
+            dump_kwargs['download_workers'] = download_workers
+            dump_kwargs['write_workers'] = write_workers
+            dump_kwargs['resume'] = resume
         else:
             raise ValueError(out_format)
         dump_fun(coco, out_path, **dump_kwargs)
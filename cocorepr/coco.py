@@ -1,27 +1,134 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/01_coco.ipynb (unless otherwise specified).
 
 __all__ = ['logger', 'CocoElement', 'CocoInfo', 'CocoLicense', 'CocoImage', 'CocoAnnotation',
-           'CocoObjectDetectionAnnotation', 'CocoCategory', 'CocoObjectDetectionCategory', 'CocoDataset',
-           'CocoObjectDetectionDataset', 'get_dataset_class', 'MAP_COCO_TYPE_TO_DATASET_CLASS', 'merge_datasets',
-           'shuffle', 'cut_annotations_per_category', 'remove_invalid_elements']
+           'CocoObjectDetectionAnnotation', 'CocoCategory', 'CocoObjectDetectionCategory', 'CocoDataset', 'CocoIndex',
+           'CocoObjectDetectionDataset', 'get_dataset_class', 'MAP_COCO_TYPE_TO_DATASET_CLASS', 'LoadFilter',
+           'construct_dataset', 'merge_all_datasets', 'merge_datasets', 'shuffle', 'cut_annotations_per_category',
+           'remove_invalid_elements']
 
 # Cell
 
+import functools
+import hashlib
+import json
 import logging
 import random
 from abc import abstractmethod
 from datetime import datetime
 from dataclasses_json import dataclass_json
-from dataclasses import fields, asdict, field, replace
+from dataclasses import fields, asdict, field, replace, MISSING
 from pydantic.dataclasses import dataclass
 from typing import *
 from pathlib import Path
-from .utils import sanitize_filename
+from .utils import sanitize_filename, measure_time, traced
 
 # Cell
 logger = logging.getLogger()
 
 # Cell
+
+def _unwrap_optional(tp):
+    """ Optional[X] -> X
+    """
+    args = getattr(tp, '__args__', None) or ()
+    if getattr(tp, '__origin__', None) is Union and len(args) == 2 and type(None) in args:
+        return next(a for a in args if a is not type(None))
+    return tp
+
+
+def _coerce_str(v):
+    return v if type(v) is str else str(v)
+
+
+def _coerce_int(v):
+    return v if type(v) is int else int(v)
+
+
+def _coerce_int_tuple(v):
+    return tuple(x if type(x) is int else int(x) for x in v)
+
+
+def _get_coercion(tp) -> Optional[Callable[[Any], Any]]:
+    """ Returns the cheap conversion that pydantic applies to the json values
+        of a field of the (non-optional) type `tp`: `str` and `int` fields
+        are converted with `str()` and `int()`, `Tuple[int, ...]` with
+        `int()` elementwise, other tuples with `tuple()`.
+        Returns `None` for the other types.
+    """
+    if tp is str:
+        return _coerce_str
+    if tp is int:
+        return _coerce_int
+    if getattr(tp, '__origin__', None) in (tuple, Tuple):
+        args = getattr(tp, '__args__', None) or ()
+        if args and args[0] is int:
+            return _coerce_int_tuple
+        return tuple
+    return None
+
+
+_TRUSTED_FIELDS_CACHE = {}
+
+def _get_trusted_fields(cls) -> List[Tuple[str, Any, Any, Optional[Callable[[Any], Any]]]]:
+    """ For each field of the dataclass `cls` returns a tuple
+        `(name, default, default_factory, convert)`, where `convert` turns
+        a raw json value into the field value (or is `None` if no conversion
+        is required).
+    """
+    res = _TRUSTED_FIELDS_CACHE.get(cls)
+    if res is not None:
+        return res
+
+    def _nested(el_cls):
+        def convert(v):
+            return v if isinstance(v, el_cls) else el_cls.from_dict_trusted(v)
+        return convert
+
+    def _nested_list(el_cls):
+        convert_el = _nested(el_cls)
+        def convert(v):
+            return [convert_el(x) for x in v]
+        return convert
+
+    def _is_element_class(tp):
+        # compact elements (see `cocorepr.compact`) are not `CocoElement` subclasses
+        return isinstance(tp, type) and hasattr(tp, 'from_dict_trusted')
+
+    res = []
+    for f in fields(cls):
+        tp = _unwrap_optional(f.type)
+        origin = getattr(tp, '__origin__', None)
+        args = getattr(tp, '__args__', None) or ()
+        convert = None
+        if _is_element_class(tp):
+            convert = _nested(tp)
+        elif origin in (list, List) and args and _is_element_class(args[0]):
+            convert = _nested_list(args[0])
+        else:
+            convert = _get_coercion(tp)
+        res.append((f.name, f.default, f.default_factory, convert))
+    _TRUSTED_FIELDS_CACHE[cls] = res
+    return res
+
+
+_FIELD_NAMES_CACHE = {}
+
+def _to_canonical(v: Any) -> Any:
+    """ Same as `to_dict_skip_nulls` for elements, but doesn't copy the plain values
+        (which is several times faster than `asdict`).
+    """
+    if isinstance(v, CocoElement):
+        cls = type(v)
+        names = _FIELD_NAMES_CACHE.get(cls)
+        if names is None:
+            names = _FIELD_NAMES_CACHE[cls] = [f.name for f in fields(cls)]
+        values = v.__dict__
+        return {k: _to_canonical(values[k]) for k in names if values[k] is not None}
+    if isinstance(v, (list, tuple)):
+        return [_to_canonical(x) for x in v]
+    return v
+
+
 @dataclass_json
 @dataclass
 class CocoElement:
@@ -43,6 +150,53 @@ class CocoElement:
             )
         )
 
+    @classmethod
+    def from_dict_trusted(cls, D: Dict[str, Any]):
+        """ Same as `cls.from_dict(D)` but constructs the object directly,
+            without the full validation by pydantic. Only the cheap coercions
+            are applied (see `_get_coercion`): IDs are converted to strings,
+            bboxes, areas and other integer fields to ints, so the result
+            equals the one of `cls.from_dict(D)` for well-formed input.
+            WARNING! Use it only for trusted input (for example, dumped by
+                     cocorepr itself): missing required fields raise `KeyError`,
+                     values of wrong types are not reported.
+        """
+        el = object.__new__(cls)
+        values = el.__dict__
+        for name, default, default_factory, convert in _get_trusted_fields(cls):
+            if name in D:
+                v = D[name]
+                if convert is not None and v is not None:
+                    v = convert(v)
+            elif default is not MISSING:
+                v = default
+            elif default_factory is not MISSING:
+                v = default_factory()
+            else:
+                raise KeyError(name)
+            values[name] = v
+        # the marker set by pydantic after the validation (renamed in pydantic 1.10):
+        # the validators of the enclosing dataclasses skip the initialised elements
+        values['__pydantic_initialised__' if hasattr(cls, '__pydantic_initialised__') else '__initialised__'] = True
+        return el
+
+    def get_fingerprint(self) -> str:
+        """ Returns a digest of the element content: a hash of its canonical
+            serialization (sorted keys, `None` values skipped). Equal elements
+            of the same class have equal fingerprints. The value is computed
+            once and cached in the object, so the element must not be modified
+            in place afterwards (use `dataclasses.replace` instead).
+        """
+        fingerprint = self.__dict__.get('_fingerprint')
+        if fingerprint is None:
+            raw = json.dumps(
+                _to_canonical(self),
+                sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str,
+            )
+            fingerprint = hashlib.blake2b(raw.encode('utf-8'), digest_size=16).hexdigest()
+            self.__dict__['_fingerprint'] = fingerprint
+        return fingerprint
+
     @property
     def collection_name(self) -> str:
         raise NotImplementedError
@@ -206,10 +360,106 @@ class CocoDataset(CocoElement):
         non_collective = set(cls.get_non_collective_elements())
         return sorted([f.name for f in fields(default_self) if f.name not in non_collective])
 
+    @classmethod
+    def get_element_class(cls, el_name: str) -> Type[CocoElement]:
+        """ Returns the class of elements stored in the field `el_name`,
+            for example `CocoImage` for 'images'.
+        """
+        el_type = {f.name: f.type for f in fields(cls)}[el_name]
+        if el_name in cls.get_non_collective_elements():
+            return el_type
+        return el_type.__args__[0]  # List[X] -> X
+
+    @classmethod
+    def select_collections(cls, collections: Optional[Iterable[str]] = None) -> List[str]:
+        """ Returns the names of `collections` in the order of `get_collective_elements()`,
+            all of them if `collections` is `None`. Raises ValueError on unknown names.
+        """
+        all_collections = cls.get_collective_elements()
+        if collections is None:
+            return all_collections
+        collections = set(collections)
+        unknown = collections - set(all_collections)
+        if unknown:
+            raise ValueError(f'Unknown collections of {cls.__name__}: {sorted(unknown)}, expected: {all_collections}')
+        return [c for c in all_collections if c in collections]
+
+    @classmethod
+    def construct_field(
+        cls,
+        el_name: str,
+        raw: Any,
+        *,
+        trusted: bool = False,
+        load_filter: Optional['LoadFilter'] = None,
+    ) -> Any:
+        """ Constructs the value of the field `el_name` from its raw json value (`None`
+            if missing): a single element or, for a collection, the list of the raw
+            elements (any iterable) accepted by `load_filter`, so that the rejected
+            ones are never constructed. See `from_dict_trusted` for `trusted`.
+        """
+        el_class = cls.get_element_class(el_name)
+        from_dict_function = el_class.from_dict_trusted if trusted else el_class.from_dict
+        if el_name in cls.get_non_collective_elements():
+            return from_dict_function(raw or {})
+        predicate = load_filter.get_predicate(el_name) if load_filter is not None else None
+        if predicate is not None:
+            return [from_dict_function(el) for el in (raw or []) if predicate(el)]
+        return [from_dict_function(el) for el in (raw or [])]
+
+    @classmethod
+    def from_loaders(cls, loaders: Dict[str, Callable[[], Any]]) -> 'CocoDataset':
+        """ Creates a lazy dataset: the value of each collection in `loaders` is produced
+            by its loader on the first access to the collection, the other fields get
+            their default values. Operations reading all the fields (comparison, `to_dict`,
+            `dataclasses.replace`, etc.) load them all.
+        """
+        # the fields with plain defaults are class attributes, so `__getattr__` is never called for them
+        unknown = set(loaders) - set(cls.get_collective_elements())
+        if unknown:
+            raise ValueError(f'Unknown collections of {cls.__name__}: {sorted(unknown)}')
+        res = cls.from_dict_trusted({})  # all the fields have defaults
+        for name in loaders:
+            del res.__dict__[name]
+        res.__dict__['_loaders'] = dict(loaders)
+        return res
+
+    def __getattr__(self, name: str) -> Any:
+        # called only if `name` is not in `__dict__`, i.e. for the fields of a lazy dataset not loaded yet
+        loaders = self.__dict__.get('_loaders')
+        if not loaders or name not in loaders:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        value = self.__dict__[name] = loaders[name]()
+        del loaders[name]
+        return value
+
+    def is_loaded(self, el_name: str) -> bool:
+        """ Returns `False` if the field `el_name` of a lazy dataset is not loaded yet.
+        """
+        return el_name not in self.__dict__.get('_loaders', ())
+
+    @property
+    def index(self) -> 'CocoIndex':
+        """ Lookup maps between the elements of the dataset, see `CocoIndex`.
+            The index is built lazily and cached in the dataset object, a new
+            dataset (for example, produced by `dataclasses.replace`) gets a new one.
+        """
+        index = self.__dict__.get('_index')
+        if index is None:
+            index = self.__dict__['_index'] = CocoIndex(self)
+        return index
+
+    def get_sizes(self) -> Dict[str, int]:
+        """ Returns the number of elements of each collection, e.g. `{'annotations': 10, ...}`.
+            The collections of a lazy dataset not loaded yet are skipped.
+        """
+        return {k: len(getattr(self, k)) for k in self.get_collective_elements() if self.is_loaded(k)}
+
     def to_full_str(self):
+        sizes = self.get_sizes()
         return (
             f'{self.__class__.__name__}(' + \
-            ', '.join(f'{k}={len(getattr(self, k))}' for k in self.get_collective_elements()) + \
+            ', '.join(f'{k}={sizes.get(k, "?")}' for k in self.get_collective_elements()) + \
             ')'
         )
 
@@ -221,6 +471,54 @@ class CocoDataset(CocoElement):
 
 # Cell
 
+class CocoIndex:
+    """ Lookup maps between the elements of the dataset `coco`, each one is built
+        on the first access. Usually obtained as `coco.index` to be shared by all
+        operations over the same dataset.
+        WARNING! The maps are not updated if the dataset is modified in place.
+    """
+    def __init__(self, coco: 'CocoDataset'):
+        self.coco = coco
+        self._maps = {}
+
+    def _get_map(self, name: str, build: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        res = self._maps.get(name)
+        if res is None:
+            res = self._maps[name] = build()
+        return res
+
+    @property
+    def annid2ann(self) -> Dict[str, CocoAnnotation]:
+        return self._get_map('annid2ann', lambda: {ann.id: ann for ann in self.coco.annotations})
+
+    @property
+    def imgid2img(self) -> Dict[str, CocoImage]:
+        return self._get_map('imgid2img', lambda: {img.id: img for img in self.coco.images})
+
+    @property
+    def catid2cat(self) -> Dict[str, CocoCategory]:
+        return self._get_map('catid2cat', lambda: {cat.id: cat for cat in self.coco.categories})
+
+    @property
+    def imgid2anns(self) -> Dict[str, List[CocoAnnotation]]:
+        """ Annotations grouped by image ID (in order of the annotations).
+        """
+        return self._get_map('imgid2anns', lambda: self._group_annotations('image_id'))
+
+    @property
+    def catid2anns(self) -> Dict[str, List[CocoAnnotation]]:
+        """ Annotations grouped by category ID (in order of the annotations).
+        """
+        return self._get_map('catid2anns', lambda: self._group_annotations('category_id'))
+
+    def _group_annotations(self, key: str) -> Dict[str, List[CocoAnnotation]]:
+        res = {}
+        for ann in self.coco.annotations:
+            res.setdefault(getattr(ann, key), []).append(ann)
+        return res
+
+# Cell
+
 @dataclass
 class CocoObjectDetectionDataset(CocoDataset):
     annotations: List[CocoObjectDetectionAnnotation] = field(default_factory=list)
@@ -240,88 +538,191 @@ def get_dataset_class(coco_kind: str):
 
 # Cell
 
-def merge_datasets(d1: CocoDataset, d2: CocoDataset, update: bool=False) -> CocoDataset:
-    if d1 is None:
-        return d2
-    if d2 is None:
-        return d1
-    assert isinstance(d1, CocoDataset), (type(d1), d1)
-    assert isinstance(d2, CocoDataset), (type(d1), d1)
-    t1 = type(d1)
-    t2 = type(d2)
-    assert t1 == t2, f'Cannot merge datasets: {t1} != {t2}'
-
-    D1 = d1.to_dict()
-    D2 = d2.to_dict()
-    K1 = set(D1.keys())
-    K2 = set(D2.keys())
-    assert K1 == K2, f'Cannot merge datasets: {K1} != {K2}'
-
-    res = {}
-    for k in K1:
-        if isinstance(D1[k], list):
-            v1 = {x['id']: x for x in (D1[k] or [])}
-            v2 = {x['id']: x for x in (D2[k] or [])}
-            v_res = {}
-            for i in v1:
-                if i in v2 and v1[i] != v2[i]:
-                    if update:
-                        logger.warning(f"Updating '{k}' of id={i}: '{v1[i]}' -> '{v2[i]}'")
-                        v_res[i] = v2[i]
-                    else:
-                        raise ValueError(f'Invalid "{k}" of id={i}: {v1[i]} != {v2[i]}. Consider --update.')
-                else:
-                    v_res[i] = v1[i]
-            for i in v2:
-                if i in v_res:
-                    continue
-                if i in v1 and v2[i] != v1[i]:
-                    if update:
-                        logger.warning(f"Updating '{k}' of id={i}: '{v1[i]}' -> '{v2[i]}'")
-                        v_res[i] = v2[i]
-                    else:
-                        raise ValueError(f'Invalid "{k}" of id={i}: {v2[i]} != {v1[i]}. Consider --update.')
-                else:
-                    v_res[i] = v2[i]
-            res[k] = sorted(v_res.values(), key=lambda x: str(x['id']))
+def _get_bbox_area(bbox: Any) -> float:
+    try:
+        return float(bbox[2]) * float(bbox[3])
+    except (TypeError, IndexError, ValueError):
+        return 0.0  # missing or broken bbox
+
+
+@dataclass
+class LoadFilter:
+    """ Filters applied to the raw elements while loading a dataset, so that the
+        rejected elements are never constructed. Annotations are kept if their
+        category is in `category_ids`, their image is in `image_ids` and their bbox
+        area is at least `min_bbox_area`; categories and images are kept if they are
+        in `category_ids` and `image_ids` respectively. `None` means no restriction.
+        Note that images are not filtered by the annotations kept.
+    """
+    category_ids: Optional[Set[str]] = None
+    image_ids: Optional[Set[str]] = None
+    min_bbox_area: Optional[float] = None
+
+    def get_predicate(self, el_name: str) -> Optional[Callable[[Dict[str, Any]], bool]]:
+        """ Returns the predicate accepting the raw elements of the collection `el_name`
+            (or `None` if all of them are accepted).
+        """
+        category_ids, image_ids, min_bbox_area = self.category_ids, self.image_ids, self.min_bbox_area
+        checks = []
+        if el_name == 'annotations':
+            # raw IDs may be numbers in an untrusted input
+            if category_ids is not None:
+                checks.append(lambda el: str(el.get('category_id')) in category_ids)
+            if image_ids is not None:
+                checks.append(lambda el: str(el.get('image_id')) in image_ids)
+            if min_bbox_area is not None:
+                checks.append(lambda el: _get_bbox_area(el.get('bbox')) >= min_bbox_area)
+        elif el_name == 'categories' and category_ids is not None:
+            checks.append(lambda el: str(el.get('id')) in category_ids)
+        elif el_name == 'images' and image_ids is not None:
+            checks.append(lambda el: str(el.get('id')) in image_ids)
+
+        if not checks:
+            return None
+        if len(checks) == 1:
+            return checks[0]
+        return lambda el: all(check(el) for check in checks)
+
+
+def construct_dataset(
+    dataset_class: Type[CocoDataset],
+    read_raw: Callable[[str], Any],
+    *,
+    collections: Optional[Iterable[str]] = None,
+    trusted: bool = False,
+    load_filter: Optional[LoadFilter] = None,
+    lazy: bool = False,
+) -> CocoDataset:
+    """ Constructs a dataset from the raw json values of its fields returned by
+        `read_raw(el_name)` (see `CocoDataset.construct_field`). Only the non-collective
+        elements and `collections` (by default, all of them) are read, the other
+        collections are left empty. If `lazy` is set, each collection is read and
+        constructed on the first access to it (see `CocoDataset.from_loaders`).
+    """
+    non_collective = dataset_class.get_non_collective_elements()
+    collections = dataset_class.select_collections(collections)
+
+    def _load(el_name: str) -> Any:
+        raw = read_raw(el_name)
+        with measure_time('construct_field', field=el_name) as timer:
+            value = dataset_class.construct_field(el_name, raw, trusted=trusted, load_filter=load_filter)
+        logger.debug(f"  - constructed '{el_name}': elapsed {timer.elapsed}")
+        return value
+
+    if lazy:
+        res = dataset_class.from_loaders({name: functools.partial(_load, name) for name in collections})
+        for name in non_collective:
+            res.__dict__[name] = _load(name)
+        return res
+    D = {name: _load(name) for name in non_collective + collections}
+    if trusted:
+        return dataset_class.from_dict_trusted(D)
+    return dataset_class(**D)
+
+# Cell
+
+def _elements_differ(el1: CocoElement, el2: CocoElement) -> bool:
+    if el1 is el2:
+        return False
+    # the fingerprints are cached, so an element kept in the merged dataset
+    # is hashed only once however many times it is compared
+    if isinstance(el1, CocoElement) and isinstance(el2, CocoElement):
+        return el1.get_fingerprint() != el2.get_fingerprint()
+    return el1 != el2  # compact elements don't cache their fingerprints
+
+
+def merge_all_datasets(datasets: Iterable[Optional[CocoDataset]], update: bool=False) -> Optional[CocoDataset]:
+    """ Merges `datasets` in a single pass over their elements, which is the same as
+        merging them pairwise from left to right with `merge_datasets` but without
+        re-building the accumulated dataset at each step. `datasets` may be a
+        generator, the datasets are consumed one by one. `None` items are skipped.
+        Elements with the same ID must be equal, otherwise ValueError is raised
+        unless `update` is set: then the right-most element wins.
+    """
+    first = None
+    count = 0
+    res_cls = None
+    res_collections = {}
+    res_info = {}
+    for d in datasets:
+        if d is None:
+            continue
+        assert isinstance(d, CocoDataset), (type(d), d)
+        if first is None:
+            first = d
+            res_cls = type(d)
+            res_collections = {k: {} for k in res_cls.get_collective_elements()}
+        t = type(d)
+        assert t == res_cls, f'Cannot merge datasets: {res_cls} != {t}'
+        count += 1
+
+        with measure_time('merge_dataset', index=count - 1, **d.get_sizes()):
+            for k, v_res in res_collections.items():
+                # elements with equal IDs within the same dataset override each other silently
+                v_new = {}
+                for x in getattr(d, k) or []:
+                    v_new[x.id] = x
+                for i, x in v_new.items():
+                    prev = v_res.get(i)
+                    if prev is not None and _elements_differ(prev, x):
+                        if update:
+                            logger.warning(f"Updating '{k}' of id={i}: '{prev}' -> '{x}'")
+                        else:
+                            raise ValueError(f'Invalid "{k}" of id={i}: {prev} != {x}. Consider --update.')
+                    v_res[i] = x
+
+            for k in res_cls.get_non_collective_elements():
+                v_prev = res_info.get(k)
+                v = getattr(d, k)
+                if v_prev is not None and _elements_differ(v_prev, v):
+                    if not update:
+                        raise ValueError(f'key={k}: unexpectedly: {v_prev} != {v}. Consider --update.')
+                    logger.warning(f"Updating '{k}': '{v_prev}' -> '{v}'")
+                res_info[k] = v
+
+    if count <= 1:
+        return first
+
+    with measure_time('build_merged_dataset') as timer:
+        res = {
             # we are converting ID to str since sometimes its integer
-        else:
-            v1 = D1[k] or {}
-            v2 = D2[k] or {}
-            if not v1:
-                res[k] = v2
-            elif not v2:
-                res[k] = v1
-            else:
-                if v1 != v2 and not update:
-                    raise ValueError(f'key={k}: unexpectedly: {v1} != {v2}. Consider --update.')
-                elif v1 != v2 and update:
-                    logger.warning(f"Updating '{k}': '{v1}' -> '{v2}'")
-                res[k] = v2
-    return t1.from_dict(res)
+            k: sorted(v_res.values(), key=lambda x: str(x.id))
+            for k, v_res in res_collections.items()
+        }
+        res.update(res_info)
+        # all elements are already validated objects
+        res = res_cls.from_dict_trusted(res)
+        timer.args.update(res.get_sizes())
+    return res
+
+
+def merge_datasets(d1: CocoDataset, d2: CocoDataset, update: bool=False) -> CocoDataset:
+    return merge_all_datasets([d1, d2], update)
 
 # Cell
 def shuffle(arr):
     return random.sample(arr, k=len(arr))
 
 # Cell
+@traced()
 def cut_annotations_per_category(coco: CocoDataset, max_annotations_per_category: int) -> CocoDataset:
     """ Returns a copy of the input dataset where each class (category)
         contains up to `max_crops_per_class` crops (annotations)
     """
-    imgid2img = {img.id: img for img in coco.images}
-    catid2anns = {cat.id: [] for cat in coco.categories}
-    for ann in coco.annotations:
-        catid2anns[ann.category_id].append(ann)
-
+    index = coco.index
+    unknown = set(index.catid2anns) - set(index.catid2cat)
+    if unknown:
+        raise KeyError(f'Annotations refer to unknown categories: {sorted(unknown)}')
     images = {}
     annotations = {}
-    for _, anns in catid2anns.items():
+    # iterate in order of categories to get the same random choice for the same seed
+    for cat_id in index.catid2cat:
+        anns = index.catid2anns.get(cat_id, [])
         if len(anns) > max_annotations_per_category:
             anns = shuffle(anns)[:max_annotations_per_category]
         for ann in anns:
             annotations[ann.id] = ann
-            images[ann.image_id] = imgid2img[ann.image_id]
+            images[ann.image_id] = index.imgid2img[ann.image_id]
     coco = replace(coco, annotations=sorted(annotations.values(), key=lambda x: x.id))
     coco = replace(coco, images=sorted(images.values(), key=lambda x: x.id))
 
@@ -330,7 +731,9 @@ def cut_annotations_per_category(coco: CocoDataset, max_annotations_per_category
 # Cell
 from collections import defaultdict
 
+@traced()
 def remove_invalid_elements(coco: CocoDataset) -> CocoDataset:
+    # not the maps of `coco.index`: of the elements with the same ID the last valid one is kept, not the last one
     annid2ann = {ann.id: ann for ann in coco.annotations if ann.is_valid()}
     imgid2img = {img.id: img for img in coco.images if img.is_valid()}
     catid2cat = {cat.id: cat for cat in coco.categories if cat.is_valid()}
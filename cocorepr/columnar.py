@@ -0,0 +1,383 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/05_columnar.ipynb (unless otherwise specified).
+
+__all__ = ['logger', 'ColumnarObjectDetectionDataset', 'validate_dataset']
+
+# Cell
+
+import logging
+from dataclasses import dataclass, replace
+from typing import *
+
+import numpy as np
+
+from .utils import measure_time
+from .coco import *
+
+# Cell
+logger = logging.getLogger()
+
+# Cell
+
+class _Interner:
+    def __init__(self):
+        # `None` takes the first slot, so that the code of a new value is `len(index) - 1`
+        self._index = {None: -1}
+
+    def encode(self, values: Iterable[Optional[str]]) -> np.ndarray:
+        index = self._index
+        codes = [index.setdefault(v, len(index) - 1) for v in values]
+        return np.array(codes, dtype=np.int64)
+
+    def get_table(self) -> np.ndarray:
+        values = list(self._index)[1:]
+        table = np.empty(len(values), dtype=object)
+        table[:] = values
+        return table
+
+
+def _truthy(codes: np.ndarray, table: np.ndarray) -> np.ndarray:
+    """ Mask of codes pointing to non-empty strings.
+    """
+    table_truthy = np.append(table != '', False)
+    return table_truthy[codes]  # code -1 points to the appended False
+
+
+def _sort_rank(table: np.ndarray) -> np.ndarray:
+    """ Rank of each table value in the sorted order of values.
+    """
+    rank = np.empty(len(table), dtype=np.int64)
+    rank[np.argsort(table, kind='stable')] = np.arange(len(table))
+    return rank
+
+
+def _valid_mask(violations: Dict[str, np.ndarray], n: int) -> np.ndarray:
+    """ Mask of the `n` rows violating none of the rules.
+    """
+    mask = np.ones(n, dtype=bool)
+    for violation in violations.values():
+        mask &= ~violation
+    return mask
+
+
+def _last_unique(codes: np.ndarray) -> np.ndarray:
+    """ Row indices of the last occurrences of each code (like `{code: row}` in a loop).
+    """
+    _, idx_reversed = np.unique(codes[::-1], return_index=True)
+    return np.sort(len(codes) - 1 - idx_reversed)
+
+# Cell
+
+_NAN_BBOX = (np.nan,) * 4
+
+
+def _to_number(x: float) -> Union[int, float]:
+    return int(x) if x.is_integer() else x
+
+
+@dataclass
+class ColumnarObjectDetectionDataset:
+    """ Column-oriented representation of `CocoObjectDetectionDataset`.
+        Annotations are stored column-wise, images, categories and licenses
+        are kept as element objects along with their ID columns.
+        WARNING! A bbox of length other than 4 can't be stored in the column,
+                 it is replaced with `None` (such annotations are invalid anyway).
+    """
+    dataset_class: Type[CocoDataset]
+    info: CocoInfo
+    licenses: List[CocoLicense]
+
+    # interned string tables, see above
+    ann_id_table: np.ndarray
+    image_id_table: np.ndarray
+    category_id_table: np.ndarray
+    supercategory_table: np.ndarray
+
+    # annotations
+    ann_id: np.ndarray              # (N,) codes in `ann_id_table`
+    ann_image_id: np.ndarray        # (N,) codes in `image_id_table`
+    ann_category_id: np.ndarray     # (N,) codes in `category_id_table`
+    ann_supercategory: np.ndarray   # (N,) codes in `supercategory_table`
+    ann_bbox: np.ndarray            # (N, 4) float, NaN if not set
+    ann_area: np.ndarray            # (N,) float, NaN if not set
+    ann_iscrowd: np.ndarray         # (N,) float, NaN if not set
+
+    # images
+    img_id: np.ndarray              # (M,) codes in `image_id_table`
+    images: List[CocoImage]
+
+    # categories
+    cat_id: np.ndarray              # (K,) codes in `category_id_table`
+    categories: List[CocoObjectDetectionCategory]
+
+    @classmethod
+    def from_coco(cls, coco: CocoObjectDetectionDataset) -> 'ColumnarObjectDetectionDataset':
+        anns = coco.annotations
+        ann_ids = _Interner()
+        image_ids = _Interner()
+        category_ids = _Interner()
+        supercategories = _Interner()
+
+        def _optional_numbers(values):
+            return np.array([np.nan if v is None else v for v in values], dtype=np.float64).reshape(-1)
+
+        return cls(
+            dataset_class=type(coco),
+            info=coco.info,
+            licenses=list(coco.licenses),
+            ann_id=ann_ids.encode(ann.id for ann in anns),
+            ann_image_id=image_ids.encode(ann.image_id for ann in anns),
+            ann_category_id=category_ids.encode(ann.category_id for ann in anns),
+            ann_supercategory=supercategories.encode(ann.supercategory for ann in anns),
+            ann_bbox=np.array(
+                [ann.bbox if ann.bbox is not None and len(ann.bbox) == 4 else _NAN_BBOX for ann in anns],
+                dtype=np.float64,
+            ).reshape(-1, 4),
+            ann_area=_optional_numbers(ann.area for ann in anns),
+            ann_iscrowd=_optional_numbers(ann.iscrowd for ann in anns),
+            img_id=image_ids.encode(img.id for img in coco.images),
+            images=list(coco.images),
+            cat_id=category_ids.encode(cat.id for cat in coco.categories),
+            categories=list(coco.categories),
+            ann_id_table=ann_ids.get_table(),
+            image_id_table=image_ids.get_table(),
+            category_id_table=category_ids.get_table(),
+            supercategory_table=supercategories.get_table(),
+        )
+
+    def to_coco(self) -> CocoObjectDetectionDataset:
+        def _decode(codes, table):
+            return [None if c < 0 else table[c] for c in codes.tolist()]
+
+        def _optional_numbers(values):
+            return [None if np.isnan(v) else _to_number(v) for v in values.tolist()]
+
+        bboxes = [
+            None if np.isnan(b[0]) else tuple(_to_number(x) for x in b)
+            for b in self.ann_bbox.tolist()
+        ]
+        annotation_class = self.dataset_class.get_element_class('annotations')
+        annotations = [
+            annotation_class.from_dict_trusted(dict(
+                id=id, image_id=image_id, category_id=category_id, bbox=bbox,
+                supercategory=supercategory, area=area, iscrowd=iscrowd,
+            ))
+            for id, image_id, category_id, bbox, supercategory, area, iscrowd in zip(
+                _decode(self.ann_id, self.ann_id_table),
+                _decode(self.ann_image_id, self.image_id_table),
+                _decode(self.ann_category_id, self.category_id_table),
+                bboxes,
+                _decode(self.ann_supercategory, self.supercategory_table),
+                _optional_numbers(self.ann_area),
+                _optional_numbers(self.ann_iscrowd),
+            )
+        ]
+        return self.dataset_class.from_dict_trusted(dict(
+            info=self.info,
+            licenses=self.licenses,
+            annotations=annotations,
+            images=self.images,
+            categories=self.categories,
+        ))
+
+    def to_full_str(self) -> str:
+        return (
+            f'{self.__class__.__name__}(annotations={len(self.ann_id)}, categories={len(self.cat_id)}, '
+            f'images={len(self.img_id)}, licenses={len(self.licenses)})'
+        )
+
+    def take(
+        self,
+        ann_rows: Optional[np.ndarray] = None,
+        img_rows: Optional[np.ndarray] = None,
+        cat_rows: Optional[np.ndarray] = None,
+    ) -> 'ColumnarObjectDetectionDataset':
+        """ Returns a dataset with selected rows (index arrays) of annotations,
+            images and categories; `None` keeps all the rows.
+        """
+        res = self
+        if ann_rows is not None:
+            res = replace(
+                res,
+                ann_id=res.ann_id[ann_rows],
+                ann_image_id=res.ann_image_id[ann_rows],
+                ann_category_id=res.ann_category_id[ann_rows],
+                ann_supercategory=res.ann_supercategory[ann_rows],
+                ann_bbox=res.ann_bbox[ann_rows],
+                ann_area=res.ann_area[ann_rows],
+                ann_iscrowd=res.ann_iscrowd[ann_rows],
+            )
+        if img_rows is not None:
+            res = replace(res, img_id=res.img_id[img_rows], images=[res.images[i] for i in img_rows.tolist()])
+        if cat_rows is not None:
+            res = replace(res, cat_id=res.cat_id[cat_rows], categories=[res.categories[i] for i in cat_rows.tolist()])
+        return res
+
+    def _sorted_by_id(self, rows: np.ndarray, codes: np.ndarray, table: np.ndarray) -> np.ndarray:
+        return rows[np.argsort(_sort_rank(table)[codes[rows]], kind='stable')]
+
+    def get_annotations_violations(self) -> Dict[str, np.ndarray]:
+        """ Masks of annotations violating each rule of `CocoObjectDetectionAnnotation.is_valid()`.
+        """
+        bbox = self.ann_bbox
+        return {
+            'empty_id': ~_truthy(self.ann_id, self.ann_id_table),
+            'empty_image_id': ~_truthy(self.ann_image_id, self.image_id_table),
+            'empty_category_id': ~_truthy(self.ann_category_id, self.category_id_table),
+            'malformed_bbox': ~np.isfinite(bbox).all(axis=1),  # not set, not of 4 numbers
+            'negative_bbox': (np.trunc(bbox) < 0).any(axis=1),
+        }
+
+    def get_images_violations(self) -> Dict[str, np.ndarray]:
+        """ Masks of images violating each rule of `CocoImage.is_valid()`.
+        """
+        return {
+            'empty_id': ~_truthy(self.img_id, self.image_id_table),
+            'empty_coco_url': ~np.array([bool(img.coco_url) for img in self.images], dtype=bool).reshape(-1),
+        }
+
+    def get_categories_violations(self) -> Dict[str, np.ndarray]:
+        """ Masks of categories violating each rule of `CocoObjectDetectionCategory.is_valid()`.
+        """
+        return {
+            'empty_id': ~_truthy(self.cat_id, self.category_id_table),
+            'empty_name': ~np.array([bool(cat.name) for cat in self.categories], dtype=bool).reshape(-1),
+        }
+
+    def get_annotations_valid_mask(self) -> np.ndarray:
+        """ Vectorized `CocoObjectDetectionAnnotation.is_valid()`.
+        """
+        return _valid_mask(self.get_annotations_violations(), len(self.ann_id))
+
+    def get_images_valid_mask(self) -> np.ndarray:
+        """ Vectorized `CocoImage.is_valid()`.
+        """
+        return _valid_mask(self.get_images_violations(), len(self.img_id))
+
+    def get_categories_valid_mask(self) -> np.ndarray:
+        """ Vectorized `CocoObjectDetectionCategory.is_valid()`.
+        """
+        return _valid_mask(self.get_categories_violations(), len(self.cat_id))
+
+    def get_valid_rows(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Dict[str, int]]:
+        """ Checks whole collections at once and returns the rows (sorted by ID) of
+            annotations, images and categories kept by `remove_invalid_elements()`,
+            and the number of elements violating each rule, like `'annotations.negative_bbox'`.
+            An element is counted by each of the rules of its `is_valid()` that it
+            violates, the other rules are checked only for the elements passing the
+            previous ones: duplicate IDs (the last element wins), references
+            of annotations to images and categories, images and categories unused
+            by the kept annotations.
+        """
+        report = {}
+
+        def _check(collection, violations, n):
+            for rule, mask in violations.items():
+                report[f'{collection}.{rule}'] = int(mask.sum())
+            return np.flatnonzero(_valid_mask(violations, n))
+
+        def _dedup(collection, rows, codes):
+            unique_rows = rows[_last_unique(codes[rows])]
+            report[f'{collection}.duplicate_id'] = len(rows) - len(unique_rows)
+            return np.sort(unique_rows)
+
+        ann_rows = _check('annotations', self.get_annotations_violations(), len(self.ann_id))
+        ann_rows = _dedup('annotations', ann_rows, self.ann_id)
+        img_rows = _check('images', self.get_images_violations(), len(self.img_id))
+        img_rows = _dedup('images', img_rows, self.img_id)
+        cat_rows = _check('categories', self.get_categories_violations(), len(self.cat_id))
+        cat_rows = _dedup('categories', cat_rows, self.cat_id)
+
+        image_ok = np.zeros(len(self.image_id_table) + 1, dtype=bool)
+        image_ok[self.img_id[img_rows]] = True
+        category_ok = np.zeros(len(self.category_id_table) + 1, dtype=bool)
+        category_ok[self.cat_id[cat_rows]] = True
+        ann_image_ok = image_ok[self.ann_image_id[ann_rows]]
+        ann_category_ok = category_ok[self.ann_category_id[ann_rows]]
+        report['annotations.dangling_image_id'] = int((~ann_image_ok).sum())
+        report['annotations.dangling_category_id'] = int((~ann_category_ok).sum())
+        ann_rows = ann_rows[ann_image_ok & ann_category_ok]
+
+        image_used = np.zeros(len(self.image_id_table) + 1, dtype=bool)
+        image_used[self.ann_image_id[ann_rows]] = True
+        img_used = image_used[self.img_id[img_rows]]
+        report['images.unused'] = int((~img_used).sum())
+        img_rows = img_rows[img_used]
+
+        category_used = np.zeros(len(self.category_id_table) + 1, dtype=bool)
+        category_used[self.ann_category_id[ann_rows]] = True
+        cat_used = category_used[self.cat_id[cat_rows]]
+        report['categories.unused'] = int((~cat_used).sum())
+        cat_rows = cat_rows[cat_used]
+
+        return (
+            self._sorted_by_id(ann_rows, self.ann_id, self.ann_id_table),
+            self._sorted_by_id(img_rows, self.img_id, self.image_id_table),
+            self._sorted_by_id(cat_rows, self.cat_id, self.category_id_table),
+            {k: report[k] for k in sorted(report)},
+        )
+
+    def validate(self) -> Tuple['ColumnarObjectDetectionDataset', Dict[str, int]]:
+        """ Returns the result of `remove_invalid_elements()` and the number of
+            elements violating each rule (see `get_valid_rows()`).
+        """
+        ann_rows, img_rows, cat_rows, report = self.get_valid_rows()
+        return self.take(ann_rows=ann_rows, img_rows=img_rows, cat_rows=cat_rows), report
+
+    def remove_invalid_elements(self) -> 'ColumnarObjectDetectionDataset':
+        """ Vectorized `remove_invalid_elements()`: keeps only valid annotations
+            whose image and category are valid, and only the images and
+            categories used by them. Elements are sorted by ID.
+        """
+        return self.validate()[0]
+
+    def cut_annotations_per_category(
+        self,
+        max_annotations_per_category: int,
+        seed: Optional[int] = None,
+    ) -> 'ColumnarObjectDetectionDataset':
+        """ Vectorized `cut_annotations_per_category()`: randomly keeps up to
+            `max_annotations_per_category` annotations per category and only
+            the images used by them. Uses `numpy` random generator with `seed`,
+            so the sample differs from the one of `cut_annotations_per_category()`.
+        """
+        n = len(self.ann_id)
+        rng = np.random.default_rng(seed)
+        order = np.lexsort((rng.random(n), self.ann_category_id))
+        categories_sorted = self.ann_category_id[order]
+        group_starts = np.flatnonzero(np.r_[True, categories_sorted[1:] != categories_sorted[:-1]]) if n else np.array([], dtype=np.int64)
+        group_sizes = np.diff(np.r_[group_starts, n])
+        rank_in_group = np.arange(n) - np.repeat(group_starts, group_sizes)
+        ann_rows = np.sort(order[rank_in_group < max_annotations_per_category])
+        ann_rows = ann_rows[_last_unique(self.ann_id[ann_rows])]
+
+        image_used = np.zeros(len(self.image_id_table) + 1, dtype=bool)
+        image_used[self.ann_image_id[ann_rows]] = True
+        img_rows = _last_unique(self.img_id)
+        img_rows = img_rows[image_used[self.img_id[img_rows]]]
+
+        return self.take(
+            ann_rows=self._sorted_by_id(ann_rows, self.ann_id, self.ann_id_table),
+            img_rows=self._sorted_by_id(img_rows, self.img_id, self.image_id_table),
+        )
+
+# Cell
+
+def validate_dataset(coco: CocoObjectDetectionDataset) -> Tuple[CocoObjectDetectionDataset, Dict[str, int]]:
+    """ Same as `remove_invalid_elements(coco)`, but checks whole collections at once
+        with `ColumnarObjectDetectionDataset` and also returns the number of elements
+        violating each rule (see `ColumnarObjectDetectionDataset.get_valid_rows()`).
+        The kept elements are the same objects as in `coco`.
+    """
+    with measure_time('validate_dataset', **coco.get_sizes()) as timer:
+        columnar = ColumnarObjectDetectionDataset.from_coco(coco)
+        ann_rows, img_rows, cat_rows, report = columnar.get_valid_rows()
+        elements = coco.get_collective_elements() + coco.get_non_collective_elements()
+        # all elements are already validated objects
+        res = type(coco).from_dict_trusted({
+            **{el_name: getattr(coco, el_name) for el_name in elements},
+            'annotations': [coco.annotations[i] for i in ann_rows.tolist()],
+            'images': [coco.images[i] for i in img_rows.tolist()],
+            'categories': [coco.categories[i] for i in cat_rows.tolist()],
+        })
+    logger.info(f'Dataset validated: elapsed {timer.elapsed}')
+    return res, report
\ No newline at end of file
@@ -0,0 +1,210 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/06_compact.ipynb (unless otherwise specified).
+
+__all__ = ['logger', 'CompactElement', 'CompactImage', 'CompactObjectDetectionAnnotation',
+           'CompactObjectDetectionCategory', 'CompactObjectDetectionDataset', 'get_bytes_per_element']
+
+# Cell
+
+import gc
+import logging
+import sys
+import tracemalloc
+from dataclasses import dataclass, field, fields, MISSING
+from typing import *
+
+from .coco import *
+from .coco import _get_coercion, _unwrap_optional
+
+# Cell
+logger = logging.getLogger()
+
+# Cell
+
+def _add_slots(cls: type) -> type:
+    """ Re-creates the dataclass `cls` storing its fields in `__slots__` instead
+        of the instance `__dict__` (as `dataclass(slots=True)` of python 3.10).
+    """
+    names = tuple(f.name for f in fields(cls))
+    cls_dict = dict(cls.__dict__)
+    cls_dict['__slots__'] = names
+    for name in names:
+        cls_dict.pop(name, None)  # the defaults are kept by `__init__`
+    cls_dict.pop('__dict__', None)
+    cls_dict.pop('__weakref__', None)
+    return type(cls)(cls.__name__, cls.__bases__, cls_dict)
+
+
+def _intern(v: Any) -> str:
+    return sys.intern(v if type(v) is str else str(v))
+
+
+_COMPACT_FIELDS_CACHE = {}
+
+
+class CompactElement:
+    """ Base of the compact counterparts of the elements of `element_class`.
+        The values of the fields in `_converters` are converted on construction,
+        the values of the other fields are coerced as in `CocoElement.from_dict_trusted`.
+    """
+    __slots__ = ()
+    element_class: ClassVar[Type[CocoElement]]
+    _converters: ClassVar[Dict[str, Callable[[Any], Any]]] = {}
+
+    @classmethod
+    def _get_fields(cls) -> List[Tuple[str, Any, Optional[Callable[[Any], Any]]]]:
+        res = _COMPACT_FIELDS_CACHE.get(cls)
+        if res is None:
+            res = _COMPACT_FIELDS_CACHE[cls] = [
+                (f.name, f.default, cls._converters.get(f.name) or _get_coercion(_unwrap_optional(f.type)))
+                for f in fields(cls)
+            ]
+        return res
+
+    @classmethod
+    def from_dict_trusted(cls, D: Dict[str, Any]) -> 'CompactElement':
+        """ Same as `CocoElement.from_dict_trusted`.
+        """
+        el = object.__new__(cls)
+        for name, default, convert in cls._get_fields():
+            if name in D:
+                v = D[name]
+                if convert is not None and v is not None:
+                    v = convert(v)
+            elif default is not MISSING:
+                v = default
+            else:
+                raise KeyError(name)
+            setattr(el, name, v)
+        return el
+
+    @classmethod
+    def from_dict(cls, D: Dict[str, Any]) -> 'CompactElement':
+        """ Validates `D` the same way as `element_class.from_dict`.
+        """
+        return cls.from_element(cls.element_class.from_dict(D))
+
+    @classmethod
+    def from_element(cls, el: CocoElement) -> 'CompactElement':
+        return cls.from_dict_trusted(el.__dict__)
+
+    def to_element(self) -> CocoElement:
+        return self.element_class.from_dict_trusted({name: getattr(self, name) for name, _, _ in self._get_fields()})
+
+    def to_dict(self, encode_json: bool = False) -> Dict[str, Any]:
+        return self.to_element().to_dict(encode_json=encode_json)
+
+    to_dict_skip_nulls = CocoElement.to_dict_skip_nulls
+
+    def get_fingerprint(self) -> str:
+        """ Same as `CocoElement.get_fingerprint`, but not cached.
+        """
+        return self.to_element().get_fingerprint()
+
+    def is_valid(self) -> bool:
+        return self.to_element().is_valid()
+
+# Cell
+
+@_add_slots
+@dataclass
+class CompactImage(CompactElement):
+    id: str
+    coco_url: str
+    width: Optional[int] = None
+    height: Optional[int] = None
+    license: Optional[int] = None
+    file_name: Optional[str] = None
+    flickr_url: Optional[str] = None
+    date_captured: Optional[str] = None
+
+    element_class = CocoImage
+    collection_name = CocoImage.collection_name
+    get_file_name = CocoImage.get_file_name
+    is_valid = CocoImage.is_valid
+
+
+@_add_slots
+@dataclass
+class CompactObjectDetectionAnnotation(CompactElement):
+    id: str
+    image_id: str
+    category_id: str
+    bbox: Optional[Tuple[int, ...]]
+    supercategory: Optional[str] = None
+    area: Optional[int] = None
+    iscrowd: Optional[int] = None
+
+    element_class = CocoObjectDetectionAnnotation
+    _converters = {'image_id': _intern, 'category_id': _intern, 'supercategory': _intern}
+    collection_name = CocoObjectDetectionAnnotation.collection_name
+    get_file_name = CocoObjectDetectionAnnotation.get_file_name
+
+
+@_add_slots
+@dataclass
+class CompactObjectDetectionCategory(CompactElement):
+    id: str
+    name: str
+    supercategory: Optional[str] = None
+
+    element_class = CocoObjectDetectionCategory
+    _converters = {'supercategory': _intern}
+    get_dir_name = CocoObjectDetectionCategory.get_dir_name
+
+# Cell
+
+@dataclass
+class CompactObjectDetectionDataset(CocoObjectDetectionDataset):
+    annotations: List[CompactObjectDetectionAnnotation] = field(default_factory=list)
+    images: List[CompactImage] = field(default_factory=list)
+    categories: List[CompactObjectDetectionCategory] = field(default_factory=list)
+
+    def __post_init__(self):
+        pass  # unlike the base class, the fields are not validated by pydantic
+
+    @classmethod
+    def from_dict(cls, D: Dict[str, Any]) -> 'CompactObjectDetectionDataset':
+        # each element is validated and converted right away, so that the regular ones are not held together
+        return construct_dataset(cls, D.get)
+
+    @classmethod
+    def from_coco(cls, coco: CocoDataset) -> 'CompactObjectDetectionDataset':
+        """ Converts the elements of a regular dataset into the compact ones.
+        """
+        D = {name: getattr(coco, name) for name in cls.get_non_collective_elements()}
+        for name in cls.get_collective_elements():
+            el_class = cls.get_element_class(name)
+            els = getattr(coco, name)
+            D[name] = [el_class.from_element(el) for el in els] if issubclass(el_class, CompactElement) else list(els)
+        return cls.from_dict_trusted(D)
+
+    def to_coco(self) -> CocoObjectDetectionDataset:
+        """ Converts the elements back into the regular ones.
+        """
+        D = {name: getattr(self, name) for name in self.get_non_collective_elements()}
+        for name in self.get_collective_elements():
+            D[name] = [el.to_element() if isinstance(el, CompactElement) else el for el in getattr(self, name)]
+        return CocoObjectDetectionDataset.from_dict_trusted(D)
+
+
+MAP_COCO_TYPE_TO_DATASET_CLASS['compact_object_detection'] = CompactObjectDetectionDataset
+
+# Cell
+
+def get_bytes_per_element(make_elements: Callable[[], Sequence[Any]]) -> float:
+    """ Returns the memory allocated by `make_elements()` and held by its result
+        (by `tracemalloc`), divided by the number of the elements.
+    """
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        gc.collect()
+        before = tracemalloc.get_traced_memory()[0]
+        elements = make_elements()
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    return size / max(1, len(elements))
\ No newline at end of file
@@ -1,34 +1,107 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/04_crop_tree.ipynb (unless otherwise specified).
 
-__all__ = ['load_crop_tree', 'dump_crop_tree']
+__all__ = ['load_crop_tree', 'CROPS_INDEX_FILE', 'dump_crop_tree', 'CROPS_JOURNAL_FILE']
 
 # Cell
 
+import heapq
 import json
-import shutil
+import os
 import logging
-from collections import defaultdict
-from dataclasses import dataclass, Field
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, Field, replace
 from typing import *
 from pathlib import Path
-from multiprocessing import Pool, Lock
+import threading
 
-from .utils import sort_dict, measure_time, read_image, write_image, cut_bbox
+from .utils import (
+    sort_dict, measure_time, traced, read_image, encode_image, cut_bbox, delete_extra_files,
+    json_loads, json_dumps,
+)
 from .coco import *
+from .download import ImagePrefetcher
+from .pipeline import Pipeline, Stage
 
 # Cell
 
+CROPS_INDEX_FILE = 'crops_index.json'
+_CROPS_INDEX_VERSION = 1
+
+
+def _is_crop_file(entry: os.DirEntry) -> bool:
+    # other files (e.g. 'crops_failed.ndjson') and unfinished crops (hidden '.part' files) are ignored
+    return entry.name.endswith('.png') and not entry.name.startswith('.') and entry.is_file()
+
+
+def _list_crop_dirs(crops_dir: Path) -> Dict[str, int]:
+    """ Returns the mtime (ns) of each category dir of `crops_dir`.
+    """
+    with os.scandir(crops_dir) as it:
+        return {entry.name: entry.stat().st_mtime_ns for entry in sorted(it, key=lambda e: e.name) if entry.is_dir()}
+
+
+def _build_crops_index(
+    crops_dir: Path,
+    num_workers: int,
+    old_index: Optional[Dict] = None,
+    stat_files: bool = True,
+) -> Dict:
+    """ Returns the index of the crops: `{"dirs": {dir_name: {"mtime_ns": ..., "files": {ann_id: [size, mtime_ns]}}}}`.
+        Only the dirs changed since `old_index` are scanned. Unless `stat_files` is set,
+        the sizes and mtimes of the files are not collected (`None` instead).
+    """
+    old_dirs = old_index['dirs'] if old_index else {}
+
+    def _index(item: Tuple[str, int]) -> Dict:
+        dir_name, mtime_ns = item
+        old = old_dirs.get(dir_name)
+        if old is not None and old['mtime_ns'] == mtime_ns:
+            return old
+        files = {}
+        with os.scandir(crops_dir / dir_name) as it:
+            for entry in it:
+                if _is_crop_file(entry):
+                    st = entry.stat() if stat_files else None
+                    files[entry.name[:-len('.png')]] = [st.st_size, st.st_mtime_ns] if st else None
+        # the mtime is taken before the scan, so that a change during the scan makes the entry outdated
+        return {'mtime_ns': mtime_ns, 'files': files}
+
+    dirs = _list_crop_dirs(crops_dir)
+    with ThreadPoolExecutor(num_workers, thread_name_prefix='scan') as executor:
+        return {'version': _CROPS_INDEX_VERSION, 'dirs': dict(zip(dirs, executor.map(_index, dirs.items())))}
+
+
+def _read_crops_index(index_file: Path) -> Optional[Dict]:
+    if not index_file.is_file():
+        return None
+    try:
+        index = json_loads(index_file.read_bytes())
+        if index.get('version') != _CROPS_INDEX_VERSION:
+            raise ValueError(f'unsupported version {index.get("version")}')
+        return index
+    except ValueError as e:
+        logger.warning(f'Ignoring broken crops index {index_file}: {e}')
+        return None
+
+
+@traced()
 def load_crop_tree(
     source_dir: Union[str, Path],
     base_coco: CocoDataset,
     *,
     kind: str = "object_detection",
+    num_workers: int = 8,
+    use_index: bool = True,
 ) -> CocoDataset:
     """ Load modified set of crops from `{path}/crops` and use it
-        to filter out the annotations in `base_coco`.
+        to filter out the annotations in `base_coco`: the result keeps the
+        elements of `base_coco` (in their order) which have crops. Crops of
+        unknown annotations and dirs of unknown categories are reported and ignored.
+        The category dirs are scanned by `num_workers` threads. If `use_index` is set
+        and the dir has the index file `crops_index.json` (written by `dump_crop_tree`),
+        only the category dirs modified since the index was written are scanned.
     """
-    dataset_class = get_dataset_class(kind)
-
     source_dir = Path(source_dir)
     logger.info(f"Loading crop_tree from dir: {source_dir}")
     if not source_dir.is_dir():
@@ -38,114 +111,203 @@ def load_crop_tree(
     if not crops_dir.exists():
         raise ValueError(f'Source crops dir not found: {crops_dir}')
 
-    catid2cat = {cat.id: cat for cat in base_coco.categories}
-    imgid2img = {img.id: img for img in base_coco.images}
-    annid2ann = {ann.id: ann for ann in base_coco.annotations}
-    annid2imgid = {ann.id: ann.image_id for ann in base_coco.annotations}
-
-    res_cats = {}
-    res_imgs = {}
-    res_anns = {}
-
-    with measure_time() as timer1:
-        for count1, ann_dir in enumerate(crops_dir.iterdir(), 1):
-            cat_id = str(ann_dir.name.split('--')[-1])
-            cat = catid2cat[cat_id]
-
-            with measure_time() as timer2:
-                for count2, ann_file in enumerate(ann_dir.glob('*.png'), 1):
-                    ann_id = str(ann_file.stem)
-                    ann = annid2ann[ann_id]
-                    img_id = annid2imgid[ann_id]
-                    img = imgid2img[img_id]
-
-                    res_cats[cat.id] = cat
-                    res_imgs[img.id] = img
-                    res_anns[ann.id] = ann
-            logger.debug(f'- loaded {count2} crops from {ann_dir}: elapsed {timer2.elapsed}')
-        logger.info(f'Loaded from {count1} crop directories: elapsed {timer1.elapsed}')
-
-    with measure_time() as timer:
-        D = {
-            **base_coco.to_dict(),
-            'images': list(res_imgs.values()),
-            'annotations': list(res_anns.values()),
-            'categories': list(res_cats.values()),
-        }
-    logger.info(f'Dataset dict constructed: elapsed {timer.elapsed}')
-
-    with measure_time() as timer:
-        coco = dataset_class.from_dict(D)
-    logger.info(f'Dataset object constructed: elapsed {timer.elapsed}: {coco.to_full_str()}')
+    with measure_time('scan_crops') as timer:
+        old_index = _read_crops_index(source_dir / CROPS_INDEX_FILE) if use_index else None
+        crops_index = _build_crops_index(crops_dir, num_workers, old_index, stat_files=False)
+    dir2files = crops_index['dirs']
+    num_crops = sum(len(d['files']) for d in dir2files.values())
+    if old_index is not None:
+        # the entries of the unchanged dirs are taken from the old index as they are
+        num_scanned = sum(1 for dir_name, d in dir2files.items() if old_index['dirs'].get(dir_name) is not d)
+        index_str = f' ({num_scanned} changed since the index was written)'
+    else:
+        index_str = ''
+    logger.info(
+        f'Found {num_crops} crops in {len(dir2files)} crop directories{index_str}: elapsed {timer.elapsed}'
+    )
+
+    index = base_coco.index
+    catid2cat = index.catid2cat
+    annid2ann = index.annid2ann
+
+    cat_ids = set()
+    ann_ids = set()
+    unknown_dirs = []
+    unknown_crops = []
+    for dir_name, d in dir2files.items():
+        cat_id = dir_name.split('--')[-1]
+        if cat_id not in catid2cat:
+            unknown_dirs.append(dir_name)
+            continue
+        for ann_id in d['files']:
+            if ann_id not in annid2ann:
+                unknown_crops.append(f'{dir_name}/{ann_id}.png')
+                continue
+            ann_ids.add(ann_id)
+            cat_ids.add(cat_id)
+    if unknown_dirs:
+        logger.warning(
+            f'Ignoring {len(unknown_dirs)} crop directories of unknown categories: {", ".join(unknown_dirs[:5])}'
+            + (', ...' if len(unknown_dirs) > 5 else '')
+        )
+    if unknown_crops:
+        logger.warning(
+            f'Ignoring {len(unknown_crops)} crops of unknown annotations: {", ".join(sorted(unknown_crops)[:5])}'
+            + (', ...' if len(unknown_crops) > 5 else '')
+        )
+
+    with measure_time('filter_dataset') as timer:
+        annotations = [ann for ann in base_coco.annotations if ann.id in ann_ids]
+        img_ids = {ann.image_id for ann in annotations}
+        coco = replace(
+            base_coco,
+            images=[img for img in base_coco.images if img.id in img_ids],
+            annotations=annotations,
+            categories=[cat for cat in base_coco.categories if cat.id in cat_ids],
+        )
+    logger.info(
+        f'Dataset filtered, {len(base_coco.annotations) - len(annotations)} annotations '
+        f'without crops removed: elapsed {timer.elapsed}: {coco.to_full_str()}'
+    )
 
     return coco
 
 # Cell
 
-def _delete_extra_files(coco, target_dir, images_dir, crops_dir, catid2cat):
-    logger.info(f'Collecting extra files to clean in root {target_dir}')
-    to_remove = []
-
-    a = {images_dir}
-    b = {images_dir/img.get_file_name() for img in coco.images}
-    c = {crops_dir}
-    d = {crops_dir/catid2cat[cat.id].get_dir_name() for cat in coco.categories}
-    e = {crops_dir/catid2cat[ann.category_id].get_dir_name()/ann.get_file_name() for ann in coco.annotations}
-    all_files = a | b | c | d | e
-
-    for p in target_dir.glob('**/*'):
-        if p not in all_files:
-            to_remove.append(p)
-    to_remove = sorted(to_remove)
-    removed_str = '\n'.join(map(str, to_remove))
-    if removed_str:
-        removed_str = '\n' + removed_str
-    logger.info(f'Removing {len(to_remove)} files and dirs:{removed_str}')
-    # reversed so that files get deleted before their dirs
-    for p in reversed(to_remove):
-        try:
-            if p.is_file():
-                p.unlink()
-            else:
-                shutil.rmtree(str(p))
-        except BaseException as e:
-            fod = 'file' if p.is_file() else 'dir'
-            logger.warning(f'Could not delete {fod} {p} (ignoring!): {e}')
-            continue
-    logger.info(f'[.] Removed {len(to_remove)} files and dirs.')
+def _delete_extra_files(coco, target_dir, catid2cat):
+    keep = {CROPS_JOURNAL_FILE, CROPS_INDEX_FILE, 'images', 'crops'}
+    keep.update(f'images/{img.get_file_name()}' for img in coco.images)
+    keep.update(f'crops/{catid2cat[cat.id].get_dir_name()}' for cat in coco.categories)
+    keep.update(
+        f'crops/{catid2cat[ann.category_id].get_dir_name()}/{ann.get_file_name()}'
+        for ann in coco.annotations
+    )
+    delete_extra_files(target_dir, keep)
 
 
-def _process_image(img, anns, images_dir, crops_dir, catid2cat, anns_failed_file):
-    file_name = img.get_file_name()
-    image_file = images_dir / file_name
-    image = None
+CROPS_JOURNAL_FILE = 'crops_journal.ndjson'
 
-    for ann in anns:
-        cat = catid2cat[ann.category_id]
-        cat_dir = crops_dir / cat.get_dir_name()
-        cat_dir.mkdir(exist_ok=True)
 
-        ann_file = cat_dir / ann.get_file_name()
-        if ann_file.is_file():
-            continue
+class _CropJournal:
+    """ Append-only journal of `dump_crop_tree`: one json line per processed image
+        `{"image_id": ..., "crops": [...], "failed": [...]}` with the paths of its crops
+        (relative to the crops dir) written after the crops are in place. Each line is
+        written by a single `os.write` to a file opened for appending, so an interrupted
+        run can leave at most an incomplete last line, which is ignored and cut off.
+        Without `resume` the journal is started anew: the crops found in place are
+        recorded by the dump along with the processed ones.
+    """
+    def __init__(self, path: Path, resume: bool):
+        self.path = path
+        self.done = set()
+        size = 0
+        if resume and path.is_file():
+            with path.open('rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('incomplete line')
+                        record = json_loads(line)
+                    except ValueError:
+                        logger.warning(f'Ignoring broken record at offset {size} of journal {path}')
+                        break
+                    self.done.update(record['crops'])
+                    self.done.update(record['failed'])
+                    size += len(line)
+        self._fd = os.open(str(path), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        os.ftruncate(self._fd, size)
+
+    def write(self, records: List[Dict[str, Any]]):
+        for record in records:
+            os.write(self._fd, (json_dumps(record) + '\n').encode('utf-8'))
+
+    def close(self):
+        os.close(self._fd)
+
+
+def _write_bytes_atomic(path: Path, data: bytes):
+    """ Writes to a temporary file first, so that an interrupted write never leaves a partial file at `path`.
+    """
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.part')
+    try:
+        tmp_path.write_bytes(data)
+        os.replace(str(tmp_path), str(path))
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
 
-        if image is None:
-            image = read_image(image_file, download_url=img.coco_url)
-        try:
-            box = cut_bbox(image, ann.bbox)
-            write_image(box, ann_file)
-        except ValueError as e:
-            logger.error(f"{e}. Img({img.coco_url}), BBox({ann.bbox})")
-            with anns_failed_file.open('a') as f:
-                f.write(json.dumps(ann.to_dict(), ensure_ascii=False) + '\n')
 
+_CROP_WORKER_STATE = {}
+_DEFAULT_IMAGE_AREA = 640 * 480
+_ANNOTATION_COST = 10000  # per-crop overhead (slicing, encoding setup) in pixels
 
-def _process_image_list(args):
-    if not args:
-        return
-    _process_image(*args)
+
+def _init_crop_worker(images_dir: Path, crops_dir: Path):
+    """ Receives the state shared by all the chunks, runs once in each process of the 'crop' stage.
+    """
+    _CROP_WORKER_STATE['images_dir'] = images_dir
+    _CROP_WORKER_STATE['crops_dir'] = crops_dir
 
 
+def _crop_chunk(chunk):
+    """ Cuts and encodes the crops of the images of the chunk given as
+        `(key, image_file_name, coco_url, [(crop_rel_path, bbox), ...])`,
+        runs in the processes of the 'crop' stage of `dump_crop_tree`.
+        Returns `(key, crops, failed)` per image, where `crops` are `(crop_rel_path, data)`
+        and `failed` are the indices of the crops which could not be cut.
+    """
+    images_dir = _CROP_WORKER_STATE['images_dir']
+    crops_dir = _CROP_WORKER_STATE['crops_dir']
+    results = []
+    with measure_time('crop_chunk', images=len(chunk)) as timer:
+        for key, image_file_name, coco_url, todo in chunk:
+            image = read_image(images_dir / image_file_name, download_url=coco_url)
+            crops = []
+            failed = []
+            for j, (crop_rel_path, bbox) in enumerate(todo):
+                try:
+                    box = cut_bbox(image, bbox)
+                    crops.append((crop_rel_path, encode_image(box, crops_dir / crop_rel_path)))
+                except ValueError as e:
+                    logger.error(f"{e}. Img({coco_url}), BBox({bbox})")
+                    failed.append(j)
+            results.append((key, crops, failed))
+        timer.args['crops'] = sum(len(crops) for _, crops, _ in results)
+    return results
+
+
+def _get_crop_cost(img: CocoImage, anns: List[CocoAnnotation]) -> int:
+    """ Estimated cost of cropping the annotations of the image: decoding is
+        proportional to the image area, encoding to the area of the crops.
+    """
+    cost = (img.width * img.height) if img.width and img.height else _DEFAULT_IMAGE_AREA
+    for ann in anns:
+        cost += _ANNOTATION_COST
+        if ann.bbox and len(ann.bbox) == 4:
+            cost += max(0, int(ann.bbox[2] * ann.bbox[3]))
+    return cost
+
+
+def _schedule_chunks(costs: Sequence[int], num_chunks: int) -> List[List[int]]:
+    """ Splits the items with given `costs` into `num_chunks` chunks of
+        (nearly) equal total cost by the LPT rule: the most expensive items
+        go first, each to the cheapest chunk so far. Returns the item indices
+        of the non-empty chunks, the most expensive chunks first, so that
+        the stragglers do not remain for the end.
+    """
+    num_chunks = max(1, min(num_chunks, len(costs)))
+    heap = [(0, i) for i in range(num_chunks)]
+    chunks = [[] for _ in range(num_chunks)]
+    for idx in sorted(range(len(costs)), key=lambda k: -costs[k]):
+        total, i = heapq.heappop(heap)
+        chunks[i].append(idx)
+        heapq.heappush(heap, (total + costs[idx], i))
+    totals = {i: total for total, i in heap}
+    order = sorted(range(num_chunks), key=lambda i: -totals[i])
+    return [chunks[i] for i in order if chunks[i]]
+
+
+@traced()
 def dump_crop_tree(
     coco: CocoDataset,
     target_dir: Union[str, Path],
@@ -155,13 +317,41 @@ def dump_crop_tree(
     overwrite: bool = False,
     indent: Optional[int] = 4,
     num_processes: int = 1,
+    download_workers: int = 8,
+    write_workers: int = 2,
+    chunk_size: int = 16,
+    resume: bool = False,
 ) -> None:
+    """ Dumps crops of the annotations of the dataset to a crop_tree directory.
+        The images are processed by a pipeline (see `Pipeline`) of the stages:
+        - 'fetch': `download_workers` threads download the missing images
+          (see `ImagePrefetcher`, at most `ImagePrefetcher.max_per_host`
+          of them from the same host), if zero, the images are downloaded by 'crop';
+        - 'crop': `num_processes` processes decode the images and encode the crops;
+        - 'write': `write_workers` threads write the crops to files.
+        The images are passed in chunks of about `chunk_size` images balanced
+        by the estimated cost (area of the image and of the crops), the most
+        expensive first. Statistics of the stages are logged in the end.
+        Processed images are recorded in the journal `crops_journal.ndjson`:
+        if `resume` is set, the dump continues into an existing directory and
+        skips the crops recorded there without checking the files. Otherwise
+        the existing crops are checked one by one (with `overwrite`) and
+        recorded in the journal anew.
+        Crops are written atomically, so a partial crop file is never left.
+        In the end, the index of the crops `crops_index.json` is updated
+        (see `load_crop_tree`).
+    """
     try:
         from tqdm.auto import tqdm
     except ImportError:
         logger.warning("Could not import tqdm, please run 'pip install tqdm'")
-        def tqdm(it, *args, **kwargs):
-            yield from it
+        class tqdm:
+            def __init__(self, *args, **kwargs):
+                pass
+            def update(self, n=1):
+                pass
+            def close(self):
+                pass
 
     dataset_class = get_dataset_class(kind)
     if skip_nulls:
@@ -175,7 +365,7 @@ def dump_crop_tree(
     if overwrite:
         if target_dir.is_dir():
             logger.warning(f'Destination and will be overwritten: {target_dir}')
-    elif target_dir.is_dir():
+    elif target_dir.is_dir() and not resume:
         raise ValueError(f"Destination json tree dir already exists: {target_dir}")
 
     #if overwrite and target_dir.is_dir():
@@ -183,12 +373,10 @@ def dump_crop_tree(
     #    shutil.rmtree(str(target_dir))
 
     target_dir.mkdir(parents=True, exist_ok=True)
-    catid2cat = {cat.id: cat for cat in coco.categories}
-
-    imgid2img = {img.id: img for img in coco.images}
-    imgid2anns = defaultdict(list)
-    for ann in coco.annotations:
-        imgid2anns[ann.image_id].append(ann)
+    index = coco.index
+    catid2cat = index.catid2cat
+    imgid2img = index.imgid2img
+    imgid2anns = index.imgid2anns
 
     images_dir = target_dir / 'images'
     images_dir.mkdir(exist_ok=True)
@@ -200,20 +388,120 @@ def dump_crop_tree(
     anns_failed_file = crops_dir / 'crops_failed.ndjson'
 
     if overwrite and crops_dir.is_dir():
-        _delete_extra_files(coco, target_dir, images_dir, crops_dir, catid2cat)
-
-    with measure_time() as timer:
-        pairs = [
-            (imgid2img[imgid], anns, images_dir, crops_dir, catid2cat, anns_failed_file)
-            for (imgid, anns) in imgid2anns.items()
-        ]
-        #chunks = _cut_to_chunks(pairs, num_processes)
-        with Pool(num_processes) as pool:
-            #for chunk in tqdm(chunks):
-            list(tqdm(pool.imap(_process_image_list, pairs), total=len(pairs), desc='Processing images'))
-        #process_map(_process_image_list, chunks, total=len(imgid2anns), desc='Processing images', max_workers=num_processes)
+        _delete_extra_files(coco, target_dir, catid2cat)
+
+    for cat_id in index.catid2anns:
+        (crops_dir / catid2cat[cat_id].get_dir_name()).mkdir(exist_ok=True)
+
+    journal = _CropJournal(target_dir / CROPS_JOURNAL_FILE, resume)
+    if resume:
+        logger.info(f'Resuming: {len(journal.done)} crops are recorded in journal {journal.path}')
+
+    progress_lock = threading.Lock()
+
+    with measure_time('schedule_crops') as timer:
+        tasks = []
+        costs = []
+        found_records = []
+        for imgid, anns in imgid2anns.items():
+            img = imgid2img[imgid]
+            todo = []
+            found = []
+            for ann in anns:
+                crop_rel_path = f'{catid2cat[ann.category_id].get_dir_name()}/{ann.get_file_name()}'
+                if resume:
+                    done = crop_rel_path in journal.done
+                else:
+                    done = (crops_dir / crop_rel_path).is_file()
+                    if done:
+                        found.append(crop_rel_path)
+                if not done:
+                    todo.append((ann, crop_rel_path))
+            if found:
+                found_records.append({'image_id': img.id, 'crops': found, 'failed': []})
+            if todo:
+                tasks.append((img, todo))
+                costs.append(_get_crop_cost(img, [ann for ann, _ in todo]))
+        num_chunks = max(-(-len(tasks) // max(1, chunk_size)), 4 * num_processes)
+        chunks = _schedule_chunks(costs, num_chunks)
+        # so that a later resume skips the crops done by the previous runs too
+        journal.write(found_records)
+    logger.info(
+        f'Scheduled {len(tasks)} images in {len(chunks)} chunks '
+        f'({len(imgid2anns) - len(tasks)} images are done already): elapsed {timer.elapsed}'
+    )
+
+    def _get_chunks():
+        for chunk in chunks:
+            yield [
+                (idx, tasks[idx][0].get_file_name(), tasks[idx][0].coco_url,
+                 [(crop_rel_path, ann.bbox) for ann, crop_rel_path in tasks[idx][1]])
+                for idx in chunk
+            ]
+
+    def _fetch(chunk):
+        for _, image_file_name, coco_url, _ in chunk:
+            image_file = images_dir / image_file_name
+            if coco_url and not image_file.exists():
+                prefetcher.download(coco_url, image_file)
+        return chunk
+
+    def _write(results):
+        failed_anns = []
+        records = []
+        for idx, crops, failed in results:
+            for crop_rel_path, data in crops:
+                _write_bytes_atomic(crops_dir / crop_rel_path, data)
+            img, todo = tasks[idx]
+            failed_anns.extend(todo[j][0] for j in failed)
+            records.append({
+                'image_id': img.id,
+                'crops': [crop_rel_path for crop_rel_path, _ in crops],
+                'failed': [todo[j][1] for j in failed],
+            })
+        with progress_lock:
+            journal.write(records)
+            if failed_anns:
+                anns_failed.extend(failed_anns)
+                with anns_failed_file.open('a') as f:
+                    for ann in failed_anns:
+                        f.write(json_dumps(ann.to_dict()) + '\n')
+            progress.update(len(results))
+
+    prefetcher = None
+    stages = []
+    if download_workers:
+        prefetcher = ImagePrefetcher()
+        stages.append(Stage('fetch', _fetch, workers=download_workers))
+    stages.append(Stage(
+        'crop', _crop_chunk, workers=num_processes, processes=True,
+        initializer=_init_crop_worker, initargs=(images_dir, crops_dir),
+    ))
+    stages.append(Stage('write', _write, workers=write_workers))
+
+    with measure_time('crop_pipeline', images=len(tasks), chunks=len(chunks)) as timer:
+        try:
+            with Pipeline(stages) as pipeline:
+                # tqdm starts a monitor thread, so the progress bar is created after the processes are forked
+                progress = tqdm(total=len(imgid2anns), initial=len(imgid2anns) - len(tasks), desc='Processing images')
+                try:
+                    stats = pipeline.run(_get_chunks())
+                finally:
+                    progress.close()
+        finally:
+            journal.close()
+            if prefetcher is not None:
+                prefetcher.close()
 
     logger.info(f'Crops written to {crops_dir}: elapsed {timer.elapsed}')
+    for st in stats:
+        logger.info(f'- {st.to_str()}')
+
+    with measure_time('write_crops_index') as timer:
+        index_file = target_dir / CROPS_INDEX_FILE
+        crops_index = _build_crops_index(crops_dir, write_workers, _read_crops_index(index_file))
+        _write_bytes_atomic(index_file, json_dumps(crops_index, separators=(',', ':')).encode('utf-8'))
+    logger.info(f'Crops index written to {index_file}: elapsed {timer.elapsed}')
 
     if anns_failed:
         logger.warning(f'Failed to process {len(anns_failed)} crops, see file {anns_failed_file}')
\ No newline at end of file
@@ -0,0 +1,180 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/91_download.ipynb (unless otherwise specified).
+
+__all__ = ['logger', 'ImagePrefetcher']
+
+# Cell
+
+import http.client
+import logging
+import os
+import shutil
+import threading
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+from typing import *
+from urllib.parse import urlsplit, urljoin
+
+# Cell
+logger = logging.getLogger()
+
+# Cell
+
+class ImagePrefetcher:
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+    MAX_REDIRECTS = 5
+
+    def __init__(
+        self,
+        *,
+        max_per_host: int = 4,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 30.0,
+    ):
+        self.max_per_host = max_per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self._proxies = urllib.request.getproxies()
+        self._opener = urllib.request.build_opener(urllib.request.ProxyHandler(self._proxies))
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._host_semaphores = {}
+        self._connections = []  # all connections of all threads, to close them in the end
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+    def _get_host_semaphore(self, netloc: str) -> threading.Semaphore:
+        with self._lock:
+            sem = self._host_semaphores.get(netloc)
+            if sem is None:
+                sem = self._host_semaphores[netloc] = threading.BoundedSemaphore(self.max_per_host)
+            return sem
+
+    def _get_connection(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        conns = getattr(self._local, 'connections', None)
+        if conns is None:
+            conns = self._local.connections = {}
+        conn = conns.get((scheme, netloc))
+        if conn is None:
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            elif scheme == 'http':
+                conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            else:
+                raise ValueError(f'Unsupported URL scheme: {scheme}')
+            conns[(scheme, netloc)] = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _drop_connection(self, scheme: str, netloc: str):
+        conn = self._local.connections.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def _uses_urllib(self, scheme: str, hostname: str) -> bool:
+        """ The persistent connections are used only for direct http(s) requests,
+            the other schemes and the proxied requests are left to `urllib.request`.
+        """
+        if scheme not in ('http', 'https'):
+            return True
+        return scheme in self._proxies and not urllib.request.proxy_bypass(hostname)
+
+    def _fetch_urllib(self, url: str, tmp_path: Path):
+        try:
+            with self._opener.open(url, timeout=self.timeout) as resp, tmp_path.open('wb') as f:
+                shutil.copyfileobj(resp, f)
+        except urllib.error.HTTPError as e:
+            raise _HTTPStatusError(e.code, e.reason, url) from e
+
+    def _fetch_once(self, url: str, tmp_path: Path) -> Optional[str]:
+        """ Downloads `url` to `tmp_path`, returns the redirect location if any.
+        """
+        parts = urlsplit(url)
+        if self._uses_urllib(parts.scheme, parts.hostname or ''):
+            with self._get_host_semaphore(parts.netloc):
+                self._fetch_urllib(url, tmp_path)  # follows the redirects itself
+            return None
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        with self._get_host_semaphore(parts.netloc):
+            conn = self._get_connection(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', path, headers={'Connection': 'keep-alive'})
+                resp = conn.getresponse()
+                if resp.status == 200:
+                    with tmp_path.open('wb') as f:
+                        shutil.copyfileobj(resp, f)
+                else:
+                    resp.read()
+                if resp.will_close:
+                    self._drop_connection(parts.scheme, parts.netloc)
+            except (OSError, http.client.HTTPException):
+                # the connection is in unknown state, the next attempt will open a new one
+                self._drop_connection(parts.scheme, parts.netloc)
+                raise
+        if resp.status in self.REDIRECT_STATUSES:
+            return urljoin(url, resp.getheader('Location'))
+        if resp.status != 200:
+            raise _HTTPStatusError(resp.status, resp.reason, url)
+        return None
+
+    def download(self, url: str, image_path: Union[str, Path]) -> Path:
+        """ Downloads `url` to `image_path` unless the file already exists.
+            Raises `OSError` if all the attempts failed.
+        """
+        image_path = Path(image_path)
+        if image_path.exists():
+            return image_path
+        image_path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = image_path.with_name(f'.{image_path.name}.{os.getpid()}.{threading.get_ident()}.part')
+
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    location = url
+                    for _ in range(self.MAX_REDIRECTS + 1):
+                        location = self._fetch_once(location, tmp_path)
+                        if location is None:
+                            break
+                    else:
+                        raise OSError(f'Too many redirects: {url}')
+                    os.replace(str(tmp_path), str(image_path))
+                    return image_path
+                except _HTTPStatusError as e:
+                    if e.status not in self.RETRY_STATUSES or attempt == self.retries:
+                        raise
+                    error = e
+                except (OSError, http.client.HTTPException) as e:
+                    if attempt == self.retries:
+                        raise OSError(f'Could not download {url}: {e}') from e
+                    error = e
+                delay = self.backoff * 2 ** attempt
+                logger.debug(f'Download of {url} failed (attempt {attempt + 1}), retrying in {delay:.1f}s: {error}')
+                time.sleep(delay)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+
+class _HTTPStatusError(OSError):
+    def __init__(self, status: int, reason: str, url: str):
+        super().__init__(f'HTTP {status} {reason}: {url}')
+        self.status = status
\ No newline at end of file
@@ -6,12 +6,16 @@ __all__ = ['logger', 'load_json_file', 'dump_json_file']
 
 import logging
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from typing import *
 from pathlib import Path
 import json
+import re
+from contextlib import closing
 
-from .utils import sort_dict, measure_time
+from .utils import (
+    measure_time, open_compressed, open_output, strip_compression_suffix, json_loads, json_dumps,
+)
 from .coco import *
 
 # Cell
@@ -19,24 +23,206 @@ logger = logging.getLogger()
 
 # Cell
 
-def load_json_file(annotations_json: Union[str, Path], *, kind: str = "object_detection") -> CocoDataset:
-    from_dict_function = get_dataset_class(kind).from_dict
+class _JsonStreamReader:
+    """ Incremental reader of a json document from a text stream.
+        Only the part of the document being parsed is kept in memory.
+    """
+    _WHITESPACE = re.compile(r'[ \t\n\r]*')
+    _VALUE_END = set(' \t\n\r,:]}')
+
+    def __init__(self, f: 'io.TextIOBase', chunk_size: int = 1 << 20):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _read_more(self) -> bool:
+        if self._eof:
+            return False
+        # read at least as much as we already hold to keep re-parsing linear
+        chunk = self._f.read(max(self._chunk_size, len(self._buf) - self._pos))
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self) -> str:
+        """ Skips whitespaces, returns the next character or '' at the end of stream.
+        """
+        while True:
+            self._pos = self._WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._read_more():
+                return ''
+
+    def expect(self, chars: str) -> str:
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError(f"Invalid json: expected one of {chars!r}, got {c!r}")
+        self._pos += 1
+        return c
+
+    def read_value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if not self._read_more():
+                    raise
+                continue
+            if self._buf[end:end + 1] not in self._VALUE_END and self._read_more():
+                continue  # a number could have been cut by the end of the chunk
+            self._pos = end
+            return value
+
+    def iter_array(self) -> Iterator[Any]:
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self.read_value()
+            if self.expect(',]') == ']':
+                return
+
+    def iter_object_items(self) -> Iterator[Tuple[str, Any]]:
+        """ Iterates over key-value pairs of the top-level json object.
+            Array values are returned as iterators over their elements,
+            the rest of the array is skipped if the iterator is not exhausted.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(':')
+            if self.peek() == '[':
+                items = self.iter_array()
+                yield key, items
+                for _ in items:
+                    pass
+            else:
+                yield key, self.read_value()
+            if self.expect(',}') == '}':
+                return
+
+# Cell
+
+def _load_json_file_stream(
+    annotations_json: Path,
+    dataset_class: Type[CocoDataset],
+    trusted: bool = False,
+    collections: Optional[Iterable[str]] = None,
+    load_filter: Optional[LoadFilter] = None,
+) -> CocoDataset:
+    names = set(dataset_class.get_non_collective_elements() + dataset_class.select_collections(collections))
+
+    D = {}
+    with open_compressed(annotations_json, 'rt', encoding='utf-8') as f:
+        for key, value in _JsonStreamReader(f).iter_object_items():
+            if key in names:
+                D[key] = dataset_class.construct_field(key, value, trusted=trusted, load_filter=load_filter)
+                if isinstance(D[key], list):
+                    logger.debug(f"  - constructed {len(D[key])} elements of '{key}'")
+            else:
+                logger.debug(f"  - skipped key '{key}'")
+    if trusted:
+        return dataset_class.from_dict_trusted(D)
+    return dataset_class(**D)
+
+
+def _iter_field_stream(annotations_json: Path, el_name: str) -> Iterator[Any]:
+    """ Parses the json file incrementally and yields the elements of its array field
+        `el_name` (or its value if it's not an array). The fields before it are parsed
+        without constructing anything, the rest of the file is not read.
+    """
+    with open_compressed(annotations_json, 'rt', encoding='utf-8') as f:
+        for key, value in _JsonStreamReader(f).iter_object_items():
+            if key == el_name:
+                yield from value if isinstance(value, Iterator) else [value]
+                return
+
+
+def load_json_file(
+    annotations_json: Union[str, Path],
+    *,
+    kind: str = "object_detection",
+    stream: bool = False,
+    trusted: bool = False,
+    collections: Optional[Iterable[str]] = None,
+    load_filter: Optional[LoadFilter] = None,
+    lazy: bool = False,
+) -> CocoDataset:
+    """ Loads dataset from a json file. If `stream` is set, the file is parsed
+        incrementally element by element, so that neither the whole text nor
+        the whole raw dict is ever held in memory. If `trusted` is set, the
+        elements are constructed without validation (see `from_dict_trusted`).
+
+        Only the given `collections` are constructed (the others are left empty)
+        and only of the raw elements accepted by `load_filter`. If `lazy` is set,
+        each collection is constructed on the first access to it. Without `stream`
+        the whole file is still parsed at once and the parsed json is kept till
+        then; with `stream` the file is re-read on each access and only the
+        accessed collection is parsed.
+
+        Files compressed by gzip, xz or bz2 (`.json.gz`, `.json.xz`, `.json.bz2`)
+        are decompressed on the fly.
+    """
+    dataset_class = get_dataset_class(kind)
+    from_dict_function = dataset_class.from_dict_trusted if trusted else dataset_class.from_dict
 
     annotations_json = Path(annotations_json)
     logger.info(f"Loading json_file from: {annotations_json}")
-    ext = annotations_json.suffix
+    ext = strip_compression_suffix(annotations_json).suffix
     if ext != '.json':
-        raise ValueError(f'Expect .json file as input, got: {annotations_json}')
+        raise ValueError(f'Expect .json file (optionally .gz, .xz or .bz2 compressed) as input, got: {annotations_json}')
+
+    with measure_time('load_json_file', path=str(annotations_json), stream=stream) as timer:
 
-    with measure_time() as timer:
+        if stream and lazy:
+            non_collective = dataset_class.get_non_collective_elements()
 
-        with measure_time() as timer2:
-            D = json.loads(annotations_json.read_text())
-        logger.info(f"  json file loaded: elapsed {timer2.elapsed}")
+            def _read_raw(el_name: str) -> Any:
+                values = _iter_field_stream(annotations_json, el_name)
+                if el_name in non_collective:
+                    with closing(values):
+                        return next(values, None)
+                return values
 
-        with measure_time() as timer2:
-            coco = from_dict_function(D)
-        logger.info(f"  dataset constructed: elapsed {timer2.elapsed}")
+            coco = construct_dataset(
+                dataset_class, _read_raw,
+                collections=collections, trusted=trusted, load_filter=load_filter, lazy=True,
+            )
+            logger.info("  dataset constructed lazily: collections are streamed on access")
+        elif stream:
+            coco = _load_json_file_stream(
+                annotations_json, dataset_class, trusted=trusted, collections=collections, load_filter=load_filter,
+            )
+            logger.info("  json file streamed and dataset constructed")
+        else:
+            with measure_time('parse_json') as timer2:
+                with open_compressed(annotations_json) as f:
+                    D = json_loads(f.read())
+            logger.info(f"  json file loaded: elapsed {timer2.elapsed}")
+
+            with measure_time('construct_dataset') as timer2:
+                if collections is None and load_filter is None and not lazy:
+                    coco = from_dict_function(D)
+                else:
+                    # each raw collection is released as soon as it is constructed
+                    coco = construct_dataset(
+                        dataset_class, lambda el_name: D.pop(el_name, None),
+                        collections=collections, trusted=trusted, load_filter=load_filter, lazy=lazy,
+                    )
+            logger.info(f"  dataset constructed: elapsed {timer2.elapsed}")
+        timer.args.update(coco.get_sizes())
 
     logger.info(f"Loaded json_file: elapsed {timer.elapsed}: {coco.to_full_str()}")
 
@@ -44,6 +230,57 @@ def load_json_file(annotations_json: Union[str, Path], *, kind: str = "object_de
 
 # Cell
 
+def _iter_dataset_items(coco: CocoDataset, skip_nulls: bool) -> Iterator[Tuple[str, Any, bool]]:
+    """ Yields the fields of `coco` in the order of `sort_dict(to_dict_function(coco))` as
+        `(name, value, is_collection)`, where the value of a collection is an iterator over
+        the raw elements sorted by id: they are converted to dicts one at a time.
+    """
+    def _to_raw(v):
+        if hasattr(v, 'to_dict_skip_nulls'):
+            return v.to_dict_skip_nulls() if skip_nulls else v.to_dict()
+        return v
+
+    for name in sorted(f.name for f in fields(coco)):
+        value = getattr(coco, name)
+        if value is None and skip_nulls:
+            continue
+        if isinstance(value, list):
+            if value and getattr(value[0], 'id', None) is not None:
+                value = sorted(value, key=lambda el: el.id)  # only the references are copied
+            yield name, map(_to_raw, value), True
+        else:
+            yield name, _to_raw(value), False
+
+
+def _iter_json_chunks(items: Iterable[Tuple[str, Any, bool]], indent: Optional[int]) -> Iterator[str]:
+    """ Yields the text of `json_dumps(dict(...), indent=indent)` of the `items` of
+        `_iter_dataset_items` piece by piece: one piece per key and per element.
+    """
+    if indent is None:
+        nl1 = nl2 = ''
+        item_sep = ', '
+    else:
+        nl1 = '\n' + ' ' * indent
+        nl2 = nl1 + ' ' * indent
+        item_sep = ','
+
+    yield '{'
+    sep = ''
+    for name, value, is_collection in items:
+        yield f'{sep}{nl1}{json_dumps(name)}: '
+        sep = item_sep
+        if not is_collection:
+            # json strings have no raw newlines, so the nested lines are indented by replacing them
+            yield json_dumps(value, indent=indent).replace('\n', nl1)
+            continue
+        el_sep = '['
+        for el in value:
+            yield f'{el_sep}{nl2}' + json_dumps(el, indent=indent).replace('\n', nl2)
+            el_sep = item_sep
+        yield '[]' if el_sep == '[' else f'{nl1}]'
+    yield '}' if not sep else f'{nl1[:1]}}}'
+
+
 def dump_json_file(
     coco: CocoDataset,
     annotations_json: Union[str, Path],
@@ -53,22 +290,21 @@ def dump_json_file(
     overwrite: bool = False,
     indent: Optional[int] = 4,
 ) -> None:
-    dataset_class = get_dataset_class(kind)
-    if skip_nulls:
-        to_dict_function = dataset_class.to_dict_skip_nulls
-    else:
-        to_dict_function = dataset_class.to_dict
-
+    """ Dumps dataset to a json file. The file is written element by element
+        (without building the whole text or the raw dict in memory) to a temporary
+        file, which replaces `annotations_json` when complete. The output is
+        the same as of `json.dumps(sort_dict(to_dict(coco)), indent=indent)`,
+        compressed if `annotations_json` ends with `.gz`, `.xz` or `.bz2`
+        (by a separate thread, while the next elements are serialized).
+        The elements are converted by their own classes, so `kind` is not used.
+    """
     annotations_json = Path(annotations_json)
     if annotations_json.is_file() and not overwrite:
         raise ValueError(f"Destination json_file already exists: {annotations_json}")
 
-    with measure_time() as timer:
-        raw = sort_dict(to_dict_function(coco))
-    logger.info(f"Sorted keys: elapsed {timer.elapsed}")
-
     logger.info(f"Writing dataset {coco.to_full_str()} to json-file: {annotations_json}")
-    with measure_time() as timer:
+    with measure_time('dump_json_file', path=str(annotations_json), **coco.get_sizes()) as timer:
         annotations_json.parent.mkdir(parents=True, exist_ok=True)
-        annotations_json.write_text(json.dumps(raw, indent=indent, ensure_ascii=False))
+        with open_output(annotations_json) as f:
+            f.writelines(_iter_json_chunks(_iter_dataset_items(coco, skip_nulls), indent))
     logger.info(f"Dataset written to {annotations_json}: elapsed {timer.elapsed}")
\ No newline at end of file
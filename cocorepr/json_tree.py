@@ -1,16 +1,25 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/03_json_tree.ipynb (unless otherwise specified).
 
-__all__ = ['logger', 'load_json_tree', 'dump_json_tree']
+__all__ = ['logger', 'load_json_tree', 'dump_json_tree', 'FINGERPRINTS_FILE']
 
 # Cell
 
 import logging
 from typing import *
 from pathlib import Path
+import hashlib
 import json
+import math
+import os
 import shutil
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from .utils import sort_dict, measure_time
+from .utils import (
+    measure_time, json_loads, json_dumps,
+    open_compressed, compress_bytes, get_compression_suffix, strip_compression_suffix,
+)
 from .coco import *
 
 # Cell
@@ -18,51 +27,285 @@ logger = logging.getLogger()
 
 # Cell
 
-def load_json_tree(tree_dir: Union[str, Path], *, kind: str = "object_detection") -> CocoDataset:
+def _read_json_file(f: Path) -> List[Any]:
+    """ Returns the elements stored in a single element file: one element
+        for `<id>.json`, one element per line for `*.ndjson` shards (which
+        may be compressed: `*.ndjson.gz`, `*.ndjson.xz`, `*.ndjson.bz2`).
+    """
+    with open_compressed(f) as fp:
+        data = fp.read()
+    if strip_compression_suffix(f).suffix == '.ndjson':
+        return [json_loads(line) for line in data.splitlines() if line.strip()]
+    return [json_loads(data)]
+
+
+def _read_json_files(files: List[Path]) -> List[Any]:
+    return [el for f in files for el in _read_json_file(f)]
+
+
+def _load_json_files(files: List[Path], num_workers: int = 1, batch_size: int = 64) -> List[Any]:
+    """ Reads and parses json `files` preserving their order. If `num_workers > 1`,
+        batches of files are read and parsed concurrently by a thread pool.
+    """
+    if num_workers <= 1 or len(files) <= batch_size:
+        return _read_json_files(files)
+
+    batches = [files[i: i + batch_size] for i in range(0, len(files), batch_size)]
+    res = []
+    with ThreadPoolExecutor(num_workers) as executor:
+        # `map` yields batches in order while the next ones are still being read
+        for batch in executor.map(_read_json_files, batches):
+            res.extend(batch)
+    return res
+
+
+def load_json_tree(
+    tree_dir: Union[str, Path],
+    *,
+    kind: str = "object_detection",
+    trusted: bool = False,
+    num_workers: int = 1,
+    batch_size: int = 64,
+    collections: Optional[Iterable[str]] = None,
+    load_filter: Optional[LoadFilter] = None,
+    lazy: bool = False,
+) -> CocoDataset:
+    """ Loads dataset from a json_tree directory. If `trusted` is set, the
+        elements are constructed without validation (see `from_dict_trusted`).
+        Element files are read by `num_workers` threads in batches of
+        `batch_size` files, the order of elements doesn't depend on it.
+        Both layouts are supported: one `<id>.json` file per element and
+        packed `*.ndjson` shards, possibly compressed (see `dump_json_tree`).
+
+        Only the directories of the given `collections` are read (the other
+        collections are left empty) and only the raw elements accepted by
+        `load_filter` are constructed. If `lazy` is set, each collection is
+        read on the first access to it (the directory must still exist then).
+    """
     dataset_class = get_dataset_class(kind)
-    from_dict_function = dataset_class.from_dict
+    from_dict_function = dataset_class.from_dict_trusted if trusted else dataset_class.from_dict
 
     tree_dir = Path(tree_dir)
     logger.info(f"Loading json_tree from dir: {tree_dir}")
     if not tree_dir.is_dir():
         raise ValueError(f"Source json_tree dir not found: {tree_dir}")
 
-    D = {}
-    with measure_time() as timer:
-
-        with measure_time() as timer2:
-
-            for el_name in dataset_class.get_collective_elements():
-                el_dir = tree_dir / el_name
-                if not el_dir.is_dir():
-                    logger.debug(f'Chunks dir not found: {el_dir}')
-                    el_list = []
-                else:
-                    el_list = [json.loads(f.read_text()) for f in el_dir.glob('*.json')]
-                logger.debug(f'Loaded {len(el_list)} json chunks from {el_dir}')
-                D[el_name] = el_list
-
-            for el_name in dataset_class.get_non_collective_elements():
-                el_file = tree_dir / f'{el_name}.json'
-                if not el_file.is_file():
-                    logger.debug(f'Chunks file not found: {el_file}')
-                    el = {}
-                else:
-                    el = json.loads(el_file.read_text())
-                logger.debug(f'Loaded single-file json chunk {el_file}')
-                D[el_name] = el
-
-        logger.info(f"- json files loaded: elapsed {timer2.elapsed}")
-
-        with measure_time() as timer2:
-            coco = dataset_class.from_dict(D)
+    def _read_raw(el_name: str) -> Any:
+        if el_name in dataset_class.get_non_collective_elements():
+            el_file = tree_dir / f'{el_name}.json'
+            if not el_file.is_file():
+                logger.debug(f'Chunks file not found: {el_file}')
+                return {}
+            logger.debug(f'Loaded single-file json chunk {el_file}')
+            return json_loads(el_file.read_bytes())
+
+        el_dir = tree_dir / el_name
+        if not el_dir.is_dir():
+            logger.debug(f'Chunks dir not found: {el_dir}')
+            return []
+        el_files = list(el_dir.glob('*.json'))
+        shard_files = sorted(p for p in el_dir.glob('*.ndjson*') if strip_compression_suffix(p).suffix == '.ndjson')
+        el_list = _load_json_files(el_files, num_workers=num_workers, batch_size=batch_size)
+        # shards are large already, so each one is a batch on its own
+        el_list += _load_json_files(shard_files, num_workers=num_workers, batch_size=1)
+        if shard_files:
+            logger.debug(f'Loaded {len(shard_files)} ndjson shards from {el_dir}')
+        logger.debug(f'Loaded {len(el_list)} json chunks from {el_dir}')
+        return el_list
+
+    with measure_time('load_json_tree', path=str(tree_dir)) as timer:
+
+        if collections is None and load_filter is None and not lazy:
+            with measure_time('read_json_files') as timer2:
+                D = {
+                    el_name: _read_raw(el_name)
+                    for el_name in dataset_class.get_collective_elements() + dataset_class.get_non_collective_elements()
+                }
+            logger.info(f"- json files loaded: elapsed {timer2.elapsed}")
+
+            with measure_time('construct_dataset') as timer2:
+                coco = from_dict_function(D)
+        else:
+            def _read_raw_timed(el_name: str) -> Any:
+                with measure_time('read_json_files', collection=el_name):
+                    return _read_raw(el_name)
+
+            # one collection is read and constructed at a time
+            with measure_time('construct_dataset') as timer2:
+                coco = construct_dataset(
+                    dataset_class, _read_raw_timed,
+                    collections=collections, trusted=trusted, load_filter=load_filter, lazy=lazy,
+                )
         logger.info(f"- dataset constructed: elapsed {timer2.elapsed}")
+        timer.args.update(coco.get_sizes())
 
     logger.info(f"Loaded from json_tree: {coco.to_full_str()}")
     return coco
 
 # Cell
 
+def _get_shard_index(el_id: Any, num_shards: int) -> int:
+    return zlib.crc32(str(el_id).encode('utf-8')) % num_shards
+
+
+def _get_shards(elements: List[CocoElement], shard_size: int) -> Dict[str, List[CocoElement]]:
+    """ Groups `elements` into shards by the hash of their ids. The hash
+        keeps each element in the same shard while the dataset changes, so
+        that the dumped trees stay diff-friendly. Elements within a shard are
+        sorted by id.
+    """
+    num_shards = 1 << max(0, math.ceil(math.log2(max(1, len(elements)) / shard_size)))
+    shards = {}
+    for el in elements:
+        shards.setdefault(_get_shard_index(el.id, num_shards), []).append(el)
+    return {
+        f'{i:05d}-of-{num_shards:05d}.ndjson': sorted(shard, key=lambda el: str(el.id))
+        for i, shard in sorted(shards.items())
+    }
+
+# Cell
+
+def _iter_json_tree_elements(
+    coco: CocoDataset,
+    dataset_class: Type[CocoDataset],
+    shard_size: Optional[int],
+) -> Iterator[Tuple[str, List[CocoElement]]]:
+    """ Yields pairs (path relative to the tree dir, elements stored in the file) for
+        all files of the json_tree representation of `coco` (the shards are not compressed).
+    """
+    # TODO: rename cat -> el_kind
+    for cat in dataset_class.get_collective_elements():
+        elements = getattr(coco, cat)
+        if not elements:
+            logger.debug(f'Skipping empty category {cat}')
+            continue
+        if shard_size is not None:
+            shards = _get_shards(elements, shard_size)
+            yield from ((f'{cat}/{shard_file}', shard) for shard_file, shard in shards.items())
+            logger.debug(f'Prepared {len(elements)} elements in {len(shards)} shards of {cat}')
+            continue
+        for el in elements:
+            yield f'{cat}/{el.id}.json', [el]
+        logger.debug(f'Prepared {len(elements)} elements of {cat}')
+
+    for cat in dataset_class.get_non_collective_elements():
+        yield f'{cat}.json', [getattr(coco, cat)]
+
+
+def _get_json_tree_file_text(rel_path: str, elements: List[CocoElement], indent: Optional[int], skip_nulls: bool) -> str:
+    # the elements are flat, so sorting all the keys by the serializer equals `sort_dict` of each element
+    raws = [el.to_dict_skip_nulls() if skip_nulls else el.to_dict() for el in elements]
+    if rel_path.endswith('.ndjson'):
+        return ''.join(json_dumps(raw, sort_keys=True) + '\n' for raw in raws)
+    return json_dumps(raws[0], indent=indent, sort_keys=True)
+
+
+def _get_json_tree_file_digest(elements: List[CocoElement]) -> str:
+    """ Digest of the content of a file of the elements, see `CocoElement.get_fingerprint`.
+    """
+    return hashlib.sha1(' '.join(el.get_fingerprint() for el in elements).encode('utf-8')).hexdigest()
+
+
+def _get_element_fingerprints(elements: List[CocoElement]) -> Dict[str, str]:
+    """ Fingerprints of the elements of a file keyed by their ids ('' for a non-collective element).
+    """
+    return {str(getattr(el, 'id', '')): el.get_fingerprint() for el in elements}
+
+
+FINGERPRINTS_FILE = '.fingerprints.json'
+
+
+def _read_fingerprints(fingerprints_file: Path, params: Dict[str, Any]) -> Dict[str, Tuple[str, int, Dict[str, str]]]:
+    """ Returns the digests, sizes and element fingerprints of the files written by
+        an incremental dump with the same `params`, keyed by their paths relative
+        to the tree dir.
+    """
+    try:
+        stored = json_loads(fingerprints_file.read_bytes())
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(stored, dict) or stored.get('params') != params:
+        return {}
+    return stored.get('files') or {}
+
+
+def _get_elements_by_collection(files: Dict[str, Tuple[str, int, Dict[str, str]]]) -> Dict[Tuple[str, str], str]:
+    """ Fingerprints of the elements of all the `files` keyed by `(collection, id)`,
+        so that an element moved to another shard is still recognized.
+    """
+    res = {}
+    for rel_path, (_, _, fingerprints) in files.items():
+        collection = rel_path.split('/', 1)[0]
+        for el_id, fingerprint in fingerprints.items():
+            res[collection, el_id] = fingerprint
+    return res
+
+
+def _count_file_elements(el_file: Path) -> int:
+    """ Number of the elements in a file of the json_tree layout (0 if it can't be read).
+    """
+    if strip_compression_suffix(el_file).suffix != '.ndjson':
+        return 1
+    try:
+        with open_compressed(el_file) as f:
+            return sum(1 for line in f if line.strip())
+    except (OSError, EOFError, ValueError):
+        return 0
+
+
+
+def _iter_layout_files(tree_dir: Path, dataset_class: Type[CocoDataset]) -> Iterator[Path]:
+    """ Yields the existing files of the json_tree layout in `tree_dir`: `<collection>/*.json`,
+        `<collection>/*.ndjson` shards (possibly compressed) and `<non_collective>.json`.
+        Other files and dirs are not touched.
+    """
+    for cat in dataset_class.get_non_collective_elements():
+        el_file = tree_dir / f'{cat}.json'
+        if el_file.is_file():
+            yield el_file
+    for cat in dataset_class.get_collective_elements():
+        el_dir = tree_dir / cat
+        if not el_dir.is_dir():
+            continue
+        with os.scandir(str(el_dir)) as it:
+            names = [entry.name for entry in it if entry.is_file()]
+        for name in names:
+            if Path(name).suffix == '.json' or strip_compression_suffix(name).suffix == '.ndjson':
+                yield el_dir / name
+
+
+def _iter_encoded_files(
+    files: Iterable[Tuple[str, str]],
+    compression: Optional[str],
+    num_workers: int,
+) -> Iterator[Tuple[str, bytes]]:
+    """ Encodes the contents of `files` in utf-8. If `compression` is set, the shards
+        are compressed (and get its suffix) by `num_workers` threads while the next
+        files are prepared: up to `2 * num_workers` files are pending.
+    """
+    if compression is None:
+        for rel_path, text in files:
+            yield rel_path, text.encode('utf-8')
+        return
+
+    def _compress(text: str) -> bytes:
+        return compress_bytes(text.encode('utf-8'), compression)
+
+    suffix = get_compression_suffix(compression)
+    pending = deque()
+    with ThreadPoolExecutor(num_workers) as executor:
+        for rel_path, text in files:
+            if rel_path.endswith('.ndjson'):
+                pending.append((rel_path + suffix, executor.submit(_compress, text)))
+            else:
+                pending.append((rel_path, executor.submit(str.encode, text, 'utf-8')))
+            if len(pending) > 2 * num_workers:
+                rel_path, future = pending.popleft()
+                yield rel_path, future.result()
+        for rel_path, future in pending:
+            yield rel_path, future.result()
+
+
 def dump_json_tree(
     coco: CocoDataset,
     target_dir: Union[str, Path],
@@ -71,49 +314,150 @@ def dump_json_tree(
     skip_nulls: bool = True,
     overwrite: bool = False,
     indent: Optional[int] = 4,
-) -> None:
+    shard_size: Optional[int] = None,
+    compression: Optional[str] = None,
+    num_workers: int = 1,
+    incremental: bool = False,
+) -> Dict[str, int]:
+    """ Dumps dataset to a json_tree directory. By default each element of
+        a collection is written to its own `<id>.json` file. If `shard_size`
+        is set, the elements are packed into `*.ndjson` shards instead
+        (one element per line, `indent` is ignored): each element goes to the
+        shard selected by the hash of its id, the number of shards is the
+        smallest power of two keeping the average shard within `shard_size`
+        elements. The shards can be compressed by `compression` ('gzip', 'xz'
+        or 'bz2') on `num_workers` threads, while the next shards are prepared.
+
+        If `incremental` is set, an existing `target_dir` is updated in place
+        instead of being deleted: only new and changed files are written and
+        files not belonging to the dataset are deleted, so that the mtime of
+        unchanged files is preserved. The digests of the written files, made
+        of the fingerprints of their elements (see `get_fingerprint`), are
+        stored in `.fingerprints.json`: the next incremental dump with the same
+        parameters doesn't even serialize the elements of the files whose
+        digest and size are unchanged (so the files edited by hand are not
+        always restored). Otherwise the result is the same as of a full dump.
+
+        Returns the number of 'added', 'changed', 'deleted' and 'unchanged'
+        files (elements, or shards in the packed layout) and of the elements
+        in them ('added_elements', etc.). The elements are compared by the
+        fingerprints stored by the previous incremental dump with the same
+        parameters; without them the elements count as their files.
+    """
+    if shard_size is not None and shard_size <= 0:
+        raise ValueError(f"Invalid shard size: {shard_size}")
+    if compression is not None:
+        get_compression_suffix(compression)  # validates the name
+        if shard_size is None:
+            raise ValueError("Compression of json_tree requires the packed layout (`shard_size`)")
     dataset_class = get_dataset_class(kind)
-    if skip_nulls:
-        to_dict_function = dataset_class.to_dict_skip_nulls
-    else:
-        to_dict_function = dataset_class.to_dict
 
     target_dir = Path(target_dir)
-    raw = to_dict_function(coco)
     logger.info(f"Dumping json_tree to dir: {target_dir}")
 
-    if overwrite:
+    if incremental:
+        if target_dir.is_dir():
+            logger.info(f'Destination dir exists and will be updated incrementally: {target_dir}')
+    elif overwrite:
         if target_dir.is_dir():
             logger.warning(f'Destination dir exists and will be overwritten: {target_dir}')
     elif target_dir.is_dir():
         raise ValueError(f"Destination json tree dir already exists: {target_dir}")
 
-    if target_dir.is_dir():
+    if target_dir.is_dir() and not incremental:
         logger.info(f'Deleting old target tree directory {target_dir}')
         shutil.rmtree(str(target_dir))
 
-    target_dir.mkdir(parents=True)
-
-    with measure_time() as timer:
-        # TODO: rename cat -> el_kind
-        for cat in dataset_class.get_collective_elements():
-            el_dir = target_dir / cat
-            if not raw.get(cat):
-                logger.debug(f'Skipping empty category {el_dir}')
-                continue
-            el_dir.mkdir()
-            for el in raw[cat]:
-                el_file = el_dir / f'{el["id"]}.json'
-                el = sort_dict(el)
-                el_file.write_text(json.dumps(el, indent=indent, ensure_ascii=False))
-            logger.debug(f'Written {len(raw[cat])} elements to {el_dir}')
-
-        for cat in dataset_class.get_non_collective_elements():
-            el_dir = target_dir / cat
-            el_dir.mkdir()
-            el_file = target_dir / f'{cat}.json'
-            el = raw[cat]
-            el = sort_dict(el)
-            el_file.write_text(json.dumps(el, indent=indent, ensure_ascii=False))
-            logger.debug(f'Written single element to {el_dir}')
-    logger.info(f'Dataset written to {target_dir}: elapsed {timer.elapsed}')
\ No newline at end of file
+    target_dir.mkdir(parents=True, exist_ok=incremental)
+
+    stats = {'added': 0, 'changed': 0, 'deleted': 0, 'unchanged': 0}
+    with measure_time('dump_json_tree', path=str(target_dir), **coco.get_sizes()) as timer:
+        el_dirs = {target_dir / cat for cat in dataset_class.get_non_collective_elements()}
+        for el_dir in el_dirs:
+            el_dir.mkdir(exist_ok=incremental)
+        el_dirs.add(target_dir)
+
+        fingerprints_file = target_dir / FINGERPRINTS_FILE
+        params = {'kind': kind, 'skip_nulls': skip_nulls, 'indent': indent, 'shard_size': shard_size, 'compression': compression}
+        prev_files = {}
+        if incremental and fingerprints_file.is_file():
+            prev_files = _read_fingerprints(fingerprints_file, params)
+            fingerprints_file.unlink()  # it is outdated once any file is rewritten
+        files = {}  # [digest, size, element fingerprints] of each file
+        outcomes = {}  # 'added', 'changed' or 'unchanged' and the number of elements of each file
+        suffix = get_compression_suffix(compression) if compression is not None else ''
+        written = set()
+
+        def _iter_files():
+            for rel_path, elements in _iter_json_tree_elements(coco, dataset_class, shard_size):
+                out_rel_path = rel_path + suffix if rel_path.endswith('.ndjson') else rel_path
+                outcomes[out_rel_path] = (None, len(elements))
+                if incremental:
+                    digest = _get_json_tree_file_digest(elements)
+                    files[out_rel_path] = [digest, None, _get_element_fingerprints(elements)]
+                    prev = prev_files.get(out_rel_path)
+                    if prev is not None and prev[0] == digest:
+                        el_file = target_dir / out_rel_path
+                        if el_file.is_file() and el_file.stat().st_size == prev[1]:
+                            written.add(el_file)
+                            files[out_rel_path][1] = prev[1]
+                            outcomes[out_rel_path] = ('unchanged', len(elements))
+                            continue
+                yield rel_path, _get_json_tree_file_text(rel_path, elements, indent, skip_nulls)
+
+        for rel_path, data in _iter_encoded_files(_iter_files(), compression, num_workers):
+            el_file = target_dir / rel_path
+            if el_file.parent not in el_dirs:
+                el_file.parent.mkdir(exist_ok=incremental)
+                el_dirs.add(el_file.parent)
+            written.add(el_file)
+            num_elements = outcomes[rel_path][1]
+            if incremental:
+                files[rel_path][1] = len(data)
+            if incremental and el_file.is_file():
+                # comparing sizes first saves reading the files that obviously changed
+                if el_file.stat().st_size == len(data) and el_file.read_bytes() == data:
+                    outcomes[rel_path] = ('unchanged', num_elements)
+                    continue
+                outcomes[rel_path] = ('changed', num_elements)
+            else:
+                outcomes[rel_path] = ('added', num_elements)
+            el_file.write_bytes(data)
+
+        element_stats = dict.fromkeys(stats, 0)
+        for outcome, num_elements in outcomes.values():
+            stats[outcome] += 1
+            if not prev_files:
+                element_stats[outcome] += num_elements
+
+        if incremental:
+            # only the files of the json_tree layout are deleted, anything else in the dir is kept
+            for el_file in _iter_layout_files(target_dir, dataset_class):
+                if el_file not in written:
+                    if not prev_files:
+                        element_stats['deleted'] += _count_file_elements(el_file)
+                    el_file.unlink()
+                    stats['deleted'] += 1
+            if prev_files:
+                prev_elements = _get_elements_by_collection(prev_files)
+                elements = _get_elements_by_collection(files)
+                for key, fingerprint in elements.items():
+                    prev_fingerprint = prev_elements.get(key)
+                    if prev_fingerprint is None:
+                        element_stats['added'] += 1
+                    elif prev_fingerprint == fingerprint:
+                        element_stats['unchanged'] += 1
+                    else:
+                        element_stats['changed'] += 1
+                element_stats['deleted'] = len(prev_elements.keys() - elements.keys())
+            for cat in dataset_class.get_collective_elements():
+                el_dir = target_dir / cat
+                if el_dir not in el_dirs and el_dir.is_dir() and not any(el_dir.iterdir()):
+                    el_dir.rmdir()
+            fingerprints = {'files': dict(sorted(files.items())), 'params': params}
+            fingerprints_file.write_text(json_dumps(fingerprints, separators=(',', ':')))
+
+        stats.update({f'{outcome}_elements': count for outcome, count in element_stats.items()})
+
+    logger.info(f'Dataset written to {target_dir}: {stats}, elapsed {timer.elapsed}')
+    return stats
\ No newline at end of file
@@ -0,0 +1,278 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/92_pipeline.ipynb (unless otherwise specified).
+
+__all__ = ['logger', 'Stage', 'StageStats', 'Pipeline']
+
+# Cell
+
+import logging
+import queue
+import threading
+import time
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from multiprocessing import Pool
+from typing import *
+
+from .utils import add_span, detach_memory_monitoring, get_tracer, start_tracing
+
+# Cell
+logger = logging.getLogger()
+
+# Cell
+
+@dataclass
+class Stage:
+    """ A step of `Pipeline`: `fn` is applied to each item by `workers` threads or,
+        if `processes` is set, by a pool of `workers` processes (then `fn`, the items
+        and the results must be picklable). `None` results are not passed further.
+        The input queue holds up to `queue_size` items (by default, `2 * workers`).
+        Each process calls `initializer(*initargs)` at start, which allows to send
+        the state shared by all the items only once instead of with each item.
+    """
+    name: str
+    fn: Callable[[Any], Any]
+    workers: int = 1
+    processes: bool = False
+    queue_size: Optional[int] = None
+    initializer: Optional[Callable[..., None]] = None
+    initargs: Tuple = ()
+
+    def get_queue_size(self) -> int:
+        return self.queue_size or 2 * self.workers
+
+
+@dataclass
+class StageStats:
+    name: str
+    workers: int
+    queue_size: int
+    items: int = 0
+    busy: float = 0.0             # total time spent by the workers on the items, seconds
+    compute: float = 0.0          # part of `busy` spent in `fn` (the rest is IPC of process stages), seconds
+    elapsed: float = 0.0          # time from the pipeline start till the last item processed, seconds
+    drain: float = 0.0            # time from the first worker running out of items till the last one, seconds
+    queue_depth_sum: int = 0
+    queue_depth_max: int = 0
+    latencies: List[float] = field(default_factory=list, repr=False)  # time of each item, seconds
+
+    @property
+    def throughput(self) -> float:
+        """ Items per second.
+        """
+        return self.items / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def utilization(self) -> float:
+        """ Fraction of time the workers were busy.
+        """
+        return self.busy / (self.elapsed * self.workers) if self.elapsed else 0.0
+
+    @property
+    def ipc_share(self) -> float:
+        """ Fraction of the busy time spent on sending items to processes and results back.
+        """
+        return (self.busy - self.compute) / self.busy if self.busy else 0.0
+
+    @property
+    def queue_depth_avg(self) -> float:
+        return self.queue_depth_sum / self.items if self.items else 0.0
+
+    def get_latency(self, q: float) -> float:
+        """ Quantile `q` of the time of an item, seconds.
+        """
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def to_str(self) -> str:
+        return (
+            f"stage '{self.name}' ({self.workers} workers): {self.items} items, "
+            f"{self.throughput:.1f} items/s, utilization {self.utilization:.0%}, IPC {self.ipc_share:.0%}, "
+            f"latency p50 {self.get_latency(0.5):.3f}s / p95 {self.get_latency(0.95):.3f}s / "
+            f"max {self.get_latency(1.0):.3f}s, drain {self.drain:.3f}s, "
+            f"queue depth avg {self.queue_depth_avg:.1f} / max {self.queue_depth_max} of {self.queue_size}"
+        )
+
+# Cell
+
+_DONE = object()  # end of the items in a queue
+_POLL_INTERVAL = 0.1
+
+
+def _init_process(initializer: Optional[Callable[..., None]], initargs: Tuple, trace: bool):
+    """ Runs at start of each process of a stage.
+    """
+    detach_memory_monitoring()
+    if trace:
+        start_tracing()
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _call_timed(fn: Callable[[Any], Any], item: Any) -> Tuple[Any, float, Optional[List[Dict[str, Any]]]]:
+    """ Runs in a process of a stage to measure `fn` without the IPC,
+        the spans recorded in the process are passed along with the result.
+    """
+    start = time.perf_counter()
+    res = fn(item)
+    compute = time.perf_counter() - start
+    tracer = get_tracer()
+    return res, compute, tracer.pop_events() if tracer is not None else None
+
+
+class Pipeline:
+    def __init__(self, stages: List[Stage]):
+        if not stages:
+            raise ValueError('Pipeline requires at least one stage')
+        for stage in stages:
+            if stage.workers < 1:
+                raise ValueError(f"Invalid number of workers of stage '{stage.name}': {stage.workers}")
+        self.stages = stages
+        self._pools = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        """ Forks the processes of the stages, which are then reused by all the runs
+            till `close`. A forked process inherits the locks held by the other threads
+            at that moment and may wait for them forever (e.g. in a finalizer called by
+            its garbage collector), so call it before starting any thread (a progress bar,
+            a monitor, etc.). Otherwise `run` starts the processes itself.
+        """
+        if self._pools is None:
+            trace = get_tracer() is not None
+            self._pools = [
+                Pool(stage.workers, _init_process, (stage.initializer, stage.initargs, trace))
+                if stage.processes else None
+                for stage in self.stages
+            ]
+
+    def close(self):
+        if self._pools is not None:
+            for pool in self._pools:
+                if pool is not None:
+                    pool.terminate()
+            self._pools = None
+
+    def run(self, items: Iterable[Any]) -> List[StageStats]:
+        """ Passes `items` through all the stages and returns their statistics.
+            The first error raised by a stage (or by `items`) stops the pipeline
+            and is re-raised.
+        """
+        stages = self.stages
+        queues = [queue.Queue(maxsize=stage.get_queue_size()) for stage in stages]
+        stats = [StageStats(stage.name, stage.workers, stage.get_queue_size()) for stage in stages]
+        alive = [stage.workers for stage in stages]
+        first_exit = [None for _ in stages]
+        lock = threading.Lock()
+        stop = threading.Event()
+        errors = []
+        start = time.perf_counter()
+        wall_start = time.time()
+
+        def _put(q, item) -> bool:
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=_POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def _get(q) -> Any:
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=_POLL_INTERVAL)
+                except queue.Empty:
+                    pass
+            return _DONE
+
+        def _fail(e):
+            with lock:
+                errors.append(e)
+            stop.set()
+
+        def _work(i: int, pool: Optional[Pool]):
+            stage = stages[i]
+            st = stats[i]
+            in_q = queues[i]
+            out_q = queues[i + 1] if i + 1 < len(stages) else None
+            while True:
+                depth = in_q.qsize()
+                item = _get(in_q)
+                if item is _DONE:
+                    break
+                t0 = time.perf_counter()
+                try:
+                    if pool is not None:
+                        res, compute, events = pool.apply(_call_timed, (stage.fn, item))
+                        tracer = get_tracer()
+                        if events and tracer is not None:
+                            tracer.events.extend(events)
+                    else:
+                        res = stage.fn(item)
+                        compute = None
+                except BaseException as e:
+                    _fail(e)
+                    break
+                t1 = time.perf_counter()
+                with lock:
+                    st.items += 1
+                    st.busy += t1 - t0
+                    st.compute += t1 - t0 if compute is None else compute
+                    st.latencies.append(t1 - t0)
+                    st.elapsed = t1 - start
+                    st.queue_depth_sum += depth
+                    st.queue_depth_max = max(st.queue_depth_max, depth)
+                if res is not None and out_q is not None and not _put(out_q, res):
+                    break
+            with lock:
+                alive[i] -= 1
+                last = alive[i] == 0
+                now = time.perf_counter()
+                if first_exit[i] is None:
+                    first_exit[i] = now
+                if last:
+                    st.drain = now - first_exit[i]
+            if last and out_q is not None:
+                for _ in range(stages[i + 1].workers):
+                    _put(out_q, _DONE)
+
+        with ExitStack() as stack:
+            if self._pools is None:
+                # the processes are forked before any worker thread of the pipeline is started
+                stack.enter_context(self)
+            pools = self._pools
+            threads = [
+                threading.Thread(target=_work, args=(i, pools[i]), name=f'{stage.name}-{w}', daemon=True)
+                for i, stage in enumerate(stages)
+                for w in range(stage.workers)
+            ]
+            for t in threads:
+                t.start()
+            try:
+                for item in items:
+                    if not _put(queues[0], item):
+                        break
+                for _ in range(stages[0].workers):
+                    _put(queues[0], _DONE)
+            except BaseException as e:
+                _fail(e)
+            for t in threads:
+                t.join()
+
+        for st in stats:
+            add_span(
+                f'stage {st.name}', wall_start, st.elapsed,
+                workers=st.workers, items=st.items, busy=st.busy, compute=st.compute, drain=st.drain,
+                queue_depth_avg=st.queue_depth_avg, queue_depth_max=st.queue_depth_max,
+            )
+        if errors:
+            raise errors[0]
+        return stats
\ No newline at end of file
@@ -1,67 +1,473 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/90_utils.ipynb (unless otherwise specified).
 
-__all__ = ['TimerMutable', 'measure_time', 'log_elapsed_time', 'sort_dict', 'sanitize_filename', 'read_image',
-           'download_image', 'cut_bbox', 'write_image']
+__all__ = ['logger', 'get_rss', 'MemoryStage', 'MemoryMonitor', 'start_memory_monitoring', 'stop_memory_monitoring',
+           'get_memory_monitor', 'detach_memory_monitoring', 'memory_monitoring', 'TimerMutable', 'Tracer',
+           'start_tracing', 'stop_tracing', 'get_tracer', 'tracing', 'add_span', 'measure_time', 'log_elapsed_time',
+           'traced', 'sort_dict', 'set_json_backend', 'get_json_backend', 'json_loads', 'json_dumps',
+           'sanitize_filename', 'read_image', 'download_image', 'cut_bbox', 'write_image', 'encode_image',
+           'delete_extra_files', 'open_atomic', 'get_compression', 'get_compression_suffix', 'strip_compression_suffix',
+           'open_compressed', 'compress_bytes', 'CompressedTextWriter', 'open_output']
 
 # Cell
 
 import re
+import bz2
 import cv2
 import datetime
+import functools
+import gzip
+import io
 import logging
+import lzma
+import os
+import queue
+import resource
+import shutil
+import sys
+import threading
+import tracemalloc
 import urllib.request
 import json
 import time
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field, asdict
 from contextlib import contextmanager
 from collections import OrderedDict
 from pathlib import Path
 from typing import *
 
+# Cell
+logger = logging.getLogger()
+
+# Cell
+
+def get_rss() -> int:
+    """ Returns the resident set size of the current process in bytes
+        (the peak one if /proc is not available).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return _get_max_rss(resource.RUSAGE_SELF)
+
+
+def _get_max_rss(who) -> int:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(who).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+@dataclass
+class MemoryStage:
+    name: str
+    depth: int                    # number of stages it is nested in
+    rss_before: int
+    rss_after: Optional[int] = None
+    rss_peak: int = 0             # sampled, so short spikes may be missed
+    top_allocations: List[Dict[str, Any]] = field(default_factory=list)
+
+
+class MemoryMonitor:
+    """ Records RSS of the process before and after each stage (a named `measure_time`
+        block, see `start_memory_monitoring`) and its peak during the stage sampled
+        by a thread every `interval` seconds. If `top_allocations` is set, also
+        records this number of the source lines which allocated most memory
+        during each stage (by `tracemalloc`, which slows the process down).
+        Memory of the worker processes is not included.
+    """
+    def __init__(self, interval: float = 0.05, top_allocations: int = 0):
+        self.interval = interval
+        self.top_allocations = top_allocations
+        self.stages = []
+        self._active = []
+        self._snapshots = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.top_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name='memory-monitor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.top_allocations and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = get_rss()
+            with self._lock:
+                for stage in self._active:
+                    stage.rss_peak = max(stage.rss_peak, rss)
+
+    def _take_snapshot(self) -> Optional['tracemalloc.Snapshot']:
+        if not self.top_allocations or not tracemalloc.is_tracing():
+            return None
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def enter(self, name: str) -> MemoryStage:
+        rss = get_rss()
+        with self._lock:
+            stage = MemoryStage(name, len(self._active), rss_before=rss, rss_peak=rss)
+            self._active.append(stage)
+            self.stages.append(stage)
+        snapshot = self._take_snapshot()
+        if snapshot is not None:
+            self._snapshots[id(stage)] = snapshot
+        return stage
+
+    def exit(self, stage: MemoryStage):
+        snapshot = self._take_snapshot()
+        start_snapshot = self._snapshots.pop(id(stage), None)
+        if snapshot is not None and start_snapshot is not None:
+            stage.top_allocations = [
+                {'site': f'{st.traceback[0].filename}:{st.traceback[0].lineno}',
+                 'size_diff': st.size_diff, 'count_diff': st.count_diff}
+                for st in snapshot.compare_to(start_snapshot, 'lineno')[:self.top_allocations]
+            ]
+        rss = get_rss()
+        with self._lock:
+            self._active.remove(stage)
+            stage.rss_after = rss
+            stage.rss_peak = max(stage.rss_peak, rss)
+            # the enclosing stages were at least at this peak too
+            for active in self._active:
+                active.rss_peak = max(active.rss_peak, stage.rss_peak)
+
+    def get_summary(self) -> Dict[str, Any]:
+        """ Returns the stages and the peak RSS of the process (and of its largest finished
+            child process) as reported by the OS, in bytes.
+        """
+        return {
+            'max_rss': _get_max_rss(resource.RUSAGE_SELF),
+            'children_max_rss': _get_max_rss(resource.RUSAGE_CHILDREN),
+            'stages': [asdict(stage) for stage in self.stages],
+        }
+
+    def log_summary(self):
+        mib = 2 ** 20
+        summary = self.get_summary()
+        logger.info(
+            f"Memory: max RSS {summary['max_rss'] / mib:.1f} MiB, "
+            f"max RSS of child processes {summary['children_max_rss'] / mib:.1f} MiB"
+        )
+        for stage in self.stages:
+            logger.info(
+                f"{'  ' * stage.depth}- {stage.name}: RSS {stage.rss_before / mib:.1f} -> "
+                f"{(stage.rss_after or 0) / mib:.1f} MiB, peak {stage.rss_peak / mib:.1f} MiB"
+            )
+            for alloc in stage.top_allocations:
+                logger.info(f"{'  ' * stage.depth}    {alloc['size_diff'] / mib:+.1f} MiB: {alloc['site']}")
+
+
+_MEMORY_MONITOR = None
+
+
+def start_memory_monitoring(**kwargs) -> MemoryMonitor:
+    """ Starts a `MemoryMonitor(**kwargs)` for the named `measure_time` blocks.
+    """
+    global _MEMORY_MONITOR
+    _MEMORY_MONITOR = MemoryMonitor(**kwargs)
+    _MEMORY_MONITOR.start()
+    return _MEMORY_MONITOR
+
+
+def stop_memory_monitoring() -> Optional[MemoryMonitor]:
+    global _MEMORY_MONITOR
+    monitor, _MEMORY_MONITOR = _MEMORY_MONITOR, None
+    if monitor is not None:
+        monitor.stop()
+    return monitor
+
+
+def get_memory_monitor() -> Optional[MemoryMonitor]:
+    return _MEMORY_MONITOR
+
+
+def detach_memory_monitoring():
+    """ Drops the monitor inherited by a forked process and stops tracemalloc in it:
+        the stages of the child are never reported, and the lock of the monitor could
+        have been held by the sampler thread of the parent at the fork.
+    """
+    global _MEMORY_MONITOR
+    _MEMORY_MONITOR = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+@contextmanager
+def memory_monitoring(summary_file: Optional[Union[str, Path]] = None, **kwargs):
+    """ Monitors memory of the stages of the block (see `MemoryMonitor`), logs
+        the results in the end and saves them to `summary_file` as json.
+    """
+    monitor = start_memory_monitoring(**kwargs)
+    try:
+        yield monitor
+    finally:
+        stop_memory_monitoring()
+        monitor.log_summary()
+        if summary_file is not None:
+            Path(summary_file).write_text(json.dumps(monitor.get_summary(), indent=4))
+            logger.info(f'Memory summary saved to {summary_file}')
+
 # Cell
 
 @dataclass(frozen=False)
 class TimerMutable:
     elapsed: Optional[datetime.timedelta] = None
+    args: Dict[str, Any] = field(default_factory=dict)  # recorded with the span, e.g. numbers of items
+
+
+class Tracer:
+    """ Collects the spans of `measure_time` (and `add_span`) as Chrome trace events,
+        which can be viewed in chrome://tracing or https://ui.perfetto.dev.
+    """
+    def __init__(self):
+        self.events = []
+        self._threads = set()
+
+    def add_span(self, name: str, start: float, duration: float, args: Dict[str, Any]):
+        """ Records a span started at `start` (`time.time()`) lasting `duration` seconds
+            in the current thread.
+        """
+        pid, tid = os.getpid(), threading.get_ident()
+        if (pid, tid) not in self._threads:
+            self._threads.add((pid, tid))
+            self.events.append({
+                'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                'args': {'name': threading.current_thread().name},
+            })
+        self.events.append({
+            'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+            'ts': round(start * 1e6), 'dur': round(duration * 1e6), 'args': args,
+        })
+
+    def pop_events(self) -> List[Dict[str, Any]]:
+        """ Returns the events collected so far and forgets them (to pass them to another process).
+        """
+        events, self.events = self.events, []
+        self._threads = set()
+        return events
+
+    def save(self, path: Union[str, Path]):
+        Path(path).write_text(json.dumps({'traceEvents': self.events, 'displayTimeUnit': 'ms'}))
+
+
+_TRACER = None
+
+
+def start_tracing() -> Tracer:
+    """ Starts recording the spans of this process into a new `Tracer`.
+    """
+    global _TRACER
+    _TRACER = Tracer()
+    return _TRACER
+
+
+def stop_tracing() -> Optional[Tracer]:
+    global _TRACER
+    tracer, _TRACER = _TRACER, None
+    return tracer
+
+
+def get_tracer() -> Optional[Tracer]:
+    return _TRACER
 
 
 @contextmanager
-def measure_time():
-    timer = TimerMutable()
+def tracing(trace_file: Union[str, Path]):
+    """ Records the spans of the block and saves them to `trace_file` in the end.
+    """
+    tracer = start_tracing()
+    try:
+        yield tracer
+    finally:
+        stop_tracing()
+        tracer.save(trace_file)
+        logger.info(f'Trace of {len(tracer.events)} events saved to {trace_file}')
+
+
+def add_span(name: str, start: float, duration: float, **args):
+    """ Records a span measured by other means than `measure_time` if tracing is on.
+    """
+    tracer = _TRACER
+    if tracer is not None:
+        tracer.add_span(name, start, duration, args)
+
+
+@contextmanager
+def measure_time(name: Optional[str] = None, **args):
+    """ Measures the time of the block into `timer.elapsed`. If `name` is given and
+        tracing is on (see `start_tracing`), the block is also recorded as a span
+        with `args` and the ones added to `timer.args` in the block. If memory
+        monitoring is on (see `start_memory_monitoring`), the block is a stage of it.
+    """
+    monitor = _MEMORY_MONITOR if name is not None else None
+    memory = monitor.enter(name) if monitor is not None else None
+    timer = TimerMutable(args=args)
     start = time.time()
-    yield timer
-    timer.elapsed = datetime.timedelta(seconds=time.time() - start)
+    try:
+        yield timer
+    finally:
+        duration = time.time() - start
+        timer.elapsed = datetime.timedelta(seconds=duration)
+        if memory is not None:
+            monitor.exit(memory)
+        if name is not None:
+            memory_args = {} if memory is None else {
+                'rss_before': memory.rss_before, 'rss_after': memory.rss_after, 'rss_peak': memory.rss_peak,
+            }
+            add_span(name, start, duration, **timer.args, **memory_args)
 
 # Cell
 
-def log_elapsed_time(log_method):
+def log_elapsed_time(log_method, name: Optional[str] = None):
+    """ Decorator which passes the timer of each call to `log_method`,
+        the call is traced as a span `name` (by default, the name of the function).
+    """
     def log(func):
         def wrapped(*args, **kwargs):
             timer = TimerMutable()
             try:
-                with measure_time() as timer:
-                    func(*args, **kwargs)
+                with measure_time(name or func.__name__) as timer:
+                    return func(*args, **kwargs)
             finally:
                 log_method(timer)
 
         return wrapped
     return log
 
+
+def traced(name: Optional[str] = None):
+    """ Decorator which traces each call as a span `name` (by default, the name of the function).
+    """
+    def trace(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with measure_time(name or func.__name__):
+                return func(*args, **kwargs)
+
+        return wrapped
+    return trace
+
 # Cell
 
-def sort_dict(D: Dict, sort_key='id') -> Dict:
+def sort_dict(D: Dict, sort_key='id', in_place: bool = False) -> Dict:
+    """ Returns `D` with sorted keys and its lists of dicts sorted by `sort_key`.
+        If `in_place` is set, the lists are sorted in place instead of being copied.
+    """
     assert isinstance(D, dict), (type(D), D)
-    return OrderedDict({
-        k: (
-            sorted(D[k], key=lambda x: x[sort_key])
-            if isinstance(D[k], list) \
-                and D[k] \
-                and isinstance(D[k][0], dict) \
-                and (sort_key in D[k][0])
-            else D[k]
-        )
-        for k in sorted(D.keys())
-    })
+
+    def _sorted(v):
+        if not (isinstance(v, list) and v and isinstance(v[0], dict) and (sort_key in v[0])):
+            return v
+        if in_place:
+            v.sort(key=lambda x: x[sort_key])
+            return v
+        return sorted(v, key=lambda x: x[sort_key])
+
+    return OrderedDict({k: _sorted(D[k]) for k in sorted(D.keys())})
+
+# Cell
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+_JSON_BACKEND = 'json'
+
+# ujson writes `1e-5` where json writes `1e-05`, the other floats are written the same way
+_UJSON_DIFFERENT_FLOAT = re.compile(r'\de-\d(?!\d)')
+# orjson parses the integers out of int64 range as floats
+_ORJSON_LONG_NUMBER = re.compile(r'\d{19}')
+_ORJSON_LONG_NUMBER_BYTES = re.compile(rb'\d{19}')
+
+
+def set_json_backend(name: Optional[str] = None) -> str:
+    """ Selects the library used by `json_loads` and `json_dumps`: 'orjson', 'ujson' or 'json'
+        (stdlib), by default the one set by env var `COCOREPR_JSON_BACKEND` or the fastest
+        installed one. orjson is used only by `json_loads` (see `json_dumps`), so the json
+        is still written by ujson (if installed). The output of `json_dumps` doesn't depend
+        on the backend.
+        Returns the name of the backend.
+    """
+    global _JSON_BACKEND
+    if name is None:
+        name = os.environ.get('COCOREPR_JSON_BACKEND')
+    if name is None:
+        name = 'orjson' if orjson is not None else 'ujson' if ujson is not None else 'json'
+    modules = {'orjson': orjson, 'ujson': ujson, 'json': json}
+    if name not in modules:
+        raise ValueError(f'Unknown json backend: {name}, expected one of: {list(modules)}')
+    if modules[name] is None:
+        raise ValueError(f"Json backend is not installed: {name}, please run 'pip install {name}'")
+    _JSON_BACKEND = name
+    return name
+
+
+def get_json_backend() -> str:
+    return _JSON_BACKEND
+
+
+def json_loads(s: Union[str, bytes]) -> Any:
+    """ Same as `json.loads(s)` but faster with orjson or ujson (see `set_json_backend`).
+    """
+    backend = _JSON_BACKEND
+    if backend == 'orjson':
+        long_number = _ORJSON_LONG_NUMBER_BYTES if isinstance(s, bytes) else _ORJSON_LONG_NUMBER
+        if long_number.search(s):
+            backend = 'ujson' if ujson is not None else 'json'
+    if backend != 'json':
+        try:
+            return orjson.loads(s) if backend == 'orjson' else ujson.loads(s)
+        except (ValueError, OverflowError):
+            pass  # e.g. `NaN` or huge integers, which json accepts
+    return json.loads(s)
+
+
+def json_dumps(
+    obj: Any,
+    *,
+    indent: Optional[int] = None,
+    separators: Optional[Tuple[str, str]] = None,
+    sort_keys: bool = False,
+) -> str:
+    """ Same as `json.dumps(obj, indent=indent, separators=separators, sort_keys=sort_keys, ensure_ascii=False)`
+        (byte to byte) but faster with ujson (see `set_json_backend`).
+        orjson is not used: it writes only the compact json or the one indented by 2,
+        while cocorepr writes indents of 4 and the default separators, and it writes
+        `NaN` as `null`. So with only orjson installed, the json is written by
+        the json module.
+    """
+    if _JSON_BACKEND != 'json' and ujson is not None and indent != 0:
+        if separators is None:
+            separators = (', ', ': ') if indent is None else (',', ': ')
+        try:
+            text = ujson.dumps(
+                obj, ensure_ascii=False, indent=indent or 0, separators=separators, sort_keys=sort_keys,
+                escape_forward_slashes=False, allow_nan=False,
+            )
+        except (TypeError, ValueError, OverflowError):
+            text = None  # e.g. `NaN`, huge integers or an older ujson without `separators`
+        if text is not None and not _UJSON_DIFFERENT_FLOAT.search(text):
+            return text
+    return json.dumps(obj, indent=indent, separators=separators, sort_keys=sort_keys, ensure_ascii=False)
+
+
+set_json_backend()
 
 # Cell
 
@@ -121,4 +527,280 @@ def write_image(image, image_path):
         image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
         cv2.imwrite(str(image_path), image)
     except cv2.error as e:
-        raise ValueError(f'Could not write image {image_path}: {e}')
\ No newline at end of file
+        raise ValueError(f'Could not write image {image_path}: {e}')
+
+
+def encode_image(image, image_path) -> bytes:
+    """ Returns the content of the file that `write_image(image, image_path)` would write.
+    """
+    try:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        ok, data = cv2.imencode(Path(image_path).suffix, image)
+    except cv2.error as e:
+        raise ValueError(f'Could not write image {image_path}: {e}')
+    if not ok:
+        raise ValueError(f'Could not write image {image_path}: encoding failed')
+    return data.tobytes()
+
+# Cell
+
+def delete_extra_files(
+    root_dir: Union[str, Path],
+    keep: Set[str],
+    *,
+    num_workers: int = 8,
+    batch_size: int = 1000,
+    dry_run: bool = False,
+) -> Tuple[int, int]:
+    """ Deletes the files and dirs under `root_dir` whose paths relative to it
+        ('/'-separated, e.g. 'crops/cat/1.png') are not in `keep`. A dir which is not
+        in `keep` is deleted with all its content without scanning it, so the parent dirs
+        of the kept files must be kept as well. The dirs are scanned by `num_workers`
+        threads with `os.scandir`, the extra files are deleted in batches of `batch_size`
+        while the scan goes on. If `dry_run` is set, nothing is deleted.
+        Returns the number of the extra files and dirs.
+    """
+    root_dir = str(root_dir)
+    action = 'Would remove' if dry_run else 'Removed'
+    num_files = num_dirs = 0
+    examples = []
+
+    def _scan(rel_dir: str) -> Tuple[List[str], List[str], List[str]]:
+        files, dirs, subdirs = [], [], []
+        prefix = rel_dir + '/' if rel_dir else ''
+        with os.scandir(os.path.join(root_dir, rel_dir)) as it:
+            for entry in it:
+                rel_path = prefix + entry.name
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if rel_path in keep:
+                    if is_dir:
+                        subdirs.append(rel_path)
+                elif is_dir:
+                    dirs.append(rel_path)
+                else:
+                    files.append(rel_path)
+        return files, dirs, subdirs
+
+    def _delete_files(rel_paths: List[str]):
+        for rel_path in rel_paths:
+            try:
+                os.unlink(os.path.join(root_dir, rel_path))
+            except OSError as e:
+                logger.warning(f'Could not delete file {rel_path} (ignoring!): {e}')
+
+    def _delete_dir(rel_path: str):
+        try:
+            shutil.rmtree(os.path.join(root_dir, rel_path))
+        except OSError as e:
+            logger.warning(f'Could not delete dir {rel_path} (ignoring!): {e}')
+
+    with measure_time('delete_extra_files', dry_run=dry_run) as timer, \
+            ThreadPoolExecutor(num_workers, thread_name_prefix='cleanup') as executor:
+        scans = {executor.submit(_scan, '')}
+        deletes = []
+        batch = []
+        while scans:
+            done, scans = wait(scans, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, dirs, subdirs = future.result()
+                scans.update(executor.submit(_scan, rel_dir) for rel_dir in subdirs)
+                num_files += len(files)
+                num_dirs += len(dirs)
+                examples.extend((dirs + files)[:max(0, 5 - len(examples))])
+                if dry_run:
+                    continue
+                deletes.extend(executor.submit(_delete_dir, rel_path) for rel_path in dirs)
+                batch.extend(files)
+                while len(batch) >= batch_size:
+                    deletes.append(executor.submit(_delete_files, batch[:batch_size]))
+                    batch = batch[batch_size:]
+        if batch:
+            deletes.append(executor.submit(_delete_files, batch))
+        for future in deletes:
+            future.result()
+        timer.args.update(files=num_files, dirs=num_dirs)
+
+    examples_str = f" (e.g. {', '.join(sorted(examples))})" if examples else ''
+    logger.info(f'{action} {num_files} files and {num_dirs} dirs in {root_dir}{examples_str}: elapsed {timer.elapsed}')
+    return num_files, num_dirs
+
+# Cell
+
+@contextmanager
+def open_atomic(path: Union[str, Path], mode: str = 'w', **kwargs):
+    """ Opens a temporary file next to `path` which replaces `path` when the block exits
+        without an error (and is removed otherwise), so that an interrupted write never
+        leaves a partial file at `path`. `kwargs` are passed to `open`.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.part')
+    try:
+        with tmp_path.open(mode, **kwargs) as f:
+            yield f
+        os.replace(str(tmp_path), str(path))
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+# Cell
+
+_COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.xz': 'xz', '.bz2': 'bz2'}
+
+
+def get_compression(path: Union[str, Path]) -> Optional[str]:
+    """ Returns the compression of the file `path` by its suffix:
+        'gzip' (.gz), 'xz' (.xz), 'bz2' (.bz2) or None.
+    """
+    return _COMPRESSION_SUFFIXES.get(Path(path).suffix)
+
+
+def get_compression_suffix(compression: Optional[str]) -> str:
+    if compression is None:
+        return ''
+    for suffix, name in _COMPRESSION_SUFFIXES.items():
+        if name == compression:
+            return suffix
+    raise ValueError(f"Unknown compression: {compression}, expected one of {list(_COMPRESSION_SUFFIXES.values())}")
+
+
+def strip_compression_suffix(path: Union[str, Path]) -> Path:
+    path = Path(path)
+    return path.with_suffix('') if get_compression(path) else path
+
+
+def open_compressed(path: Union[str, Path], mode: str = 'rb', **kwargs) -> io.IOBase:
+    """ Opens `path` for reading with `open`, decompressing the content on the fly
+        if the file is compressed (see `get_compression`).
+    """
+    compression = get_compression(path)
+    if compression == 'gzip':
+        return gzip.open(str(path), mode, **kwargs)
+    if compression == 'xz':
+        return lzma.open(str(path), mode, **kwargs)
+    if compression == 'bz2':
+        return bz2.open(str(path), mode, **kwargs)
+    return open(str(path), mode, **kwargs)
+
+
+def _open_compressor(f: io.IOBase, compression: str) -> io.IOBase:
+    get_compression_suffix(compression)  # validates the name
+    if compression == 'gzip':
+        # no file name and mtime in the header, so that the output depends only on the content
+        return gzip.GzipFile(filename='', mode='wb', fileobj=f, compresslevel=6, mtime=0)
+    if compression == 'xz':
+        return lzma.open(f, 'wb')
+    return bz2.open(f, 'wb')
+
+
+def compress_bytes(data: bytes, compression: Optional[str]) -> bytes:
+    """ Returns `data` compressed the same way as by `CompressedTextWriter`.
+    """
+    if compression is None:
+        return data
+    buf = io.BytesIO()
+    with _open_compressor(buf, compression) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class CompressedTextWriter:
+    """ Text file-like object which encodes the text in utf-8 and writes it compressed
+        by `compression` to the binary file `f`. The text is passed to the compressor
+        in chunks of `chunk_size` characters. If `threaded` is set, the chunks are
+        compressed by a separate thread (the codecs release the GIL), so that
+        the compression overlaps with producing the text: up to `queue_size`
+        chunks are waiting for it.
+    """
+    def __init__(
+        self,
+        f: io.IOBase,
+        compression: str,
+        *,
+        threaded: bool = True,
+        chunk_size: int = 1 << 20,
+        queue_size: int = 4,
+    ):
+        self._compressor = _open_compressor(f, compression)
+        self._chunk_size = chunk_size
+        self._parts = []
+        self._size = 0
+        self._error = None
+        self._queue = None
+        self._thread = None
+        if threaded:
+            self._queue = queue.Queue(maxsize=queue_size)
+            self._thread = threading.Thread(target=self._compress_queued, name='compress', daemon=True)
+            self._thread.start()
+
+    def _compress_queued(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            if self._error is None:
+                try:
+                    self._compressor.write(chunk)
+                except BaseException as e:
+                    # the chunks are still taken from the queue, so that the writer never blocks
+                    self._error = e
+
+    def _flush_chunk(self):
+        if not self._parts:
+            return
+        chunk = ''.join(self._parts).encode('utf-8')
+        self._parts = []
+        self._size = 0
+        if self._thread is None:
+            self._compressor.write(chunk)
+            return
+        if self._error is not None:
+            raise self._error
+        self._queue.put(chunk)
+
+    def write(self, s: str) -> int:
+        self._parts.append(s)
+        self._size += len(s)
+        if self._size >= self._chunk_size:
+            self._flush_chunk()
+        return len(s)
+
+    def writelines(self, lines: Iterable[str]):
+        for s in lines:
+            self.write(s)
+
+    def close(self):
+        """ Writes the rest of the text and the end of the compressed stream,
+            re-raises the error of the compression thread if any.
+        """
+        try:
+            self._flush_chunk()
+        finally:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+        if self._error is not None:
+            raise self._error
+        self._compressor.close()
+
+    def __enter__(self) -> 'CompressedTextWriter':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@contextmanager
+def open_output(path: Union[str, Path], *, threaded: bool = True, buffering: int = 1 << 20):
+    """ Opens `path` for writing text in utf-8 by `open_atomic` with a buffer of `buffering`
+        bytes. If the suffix of `path` is one of `get_compression`, the text is compressed
+        by `CompressedTextWriter(threaded=threaded)`.
+    """
+    compression = get_compression(path)
+    if compression is None:
+        with open_atomic(path, 'w', encoding='utf-8', buffering=buffering) as f:
+            yield f
+        return
+    with open_atomic(path, 'wb') as f:
+        with CompressedTextWriter(f, compression, threaded=threaded, chunk_size=buffering) as writer:
+            yield writer
\ No newline at end of file
@@ -101,11 +101,17 @@ setuptools.setup(
         "dataclasses-json>=0.5.3",
         "pydantic>=1.8.2",
         "opencv-python>=4.5.1",
+        "numpy>=1.17",
     ],
+    # orjson speeds up only the loading, the json is written faster by ujson (see `cocorepr.utils.json_dumps`)
+    extras_require={"fast_json": ["orjson>=3.5", "ujson>=4.0"]},
     python_requires=">=" + cfg["min_python"],
     long_description=long_description,
     long_description_content_type="text/markdown",
     zip_safe=False,
-    entry_points={"console_scripts": ["cocorepr=cocorepr.cli:main"]},
+    entry_points={"console_scripts": [
+        "cocorepr=cocorepr.cli:main",
+        "cocorepr_benchmarks=cocorepr.benchmarks:main",
+    ]},
     **setup_cfg
 )